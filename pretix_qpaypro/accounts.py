@@ -0,0 +1,73 @@
+import hashlib
+from collections import namedtuple
+from functools import lru_cache
+
+from django.core.cache import cache
+
+MerchantAccount = namedtuple('MerchantAccount', ['x_login', 'x_private_key', 'x_api_secret', 'weight'])
+
+MAX_WEIGHT = 100
+
+
+def parse_accounts(text: str, strict: bool = False) -> list:
+    """
+    Reads the additional accounts setting, one account per line as
+    ``login,private key,api secret[,weight]``. Invalid lines raise a
+    ValueError with ``strict``, otherwise they are skipped.
+    """
+    accounts = []
+    for number, line in enumerate((text or '').splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        parts = [part.strip() for part in line.split(',')]
+        try:
+            if len(parts) not in (3, 4) or not all(parts[:3]):
+                raise ValueError
+            weight = int(parts[3]) if len(parts) == 4 else 1
+            if not 1 <= weight <= MAX_WEIGHT:
+                raise ValueError
+        except ValueError:
+            if strict:
+                raise ValueError(number)
+            continue
+        accounts.append(MerchantAccount(parts[0], parts[1], parts[2], weight))
+    return accounts
+
+
+@lru_cache(maxsize=32)
+def get_schedule(weights: tuple) -> tuple:
+    # Smooth weighted round-robin, accounts with a higher weight get more
+    # turns without getting them all in a row
+    current = [0] * len(weights)
+    total = sum(weights)
+    schedule = []
+    for _ in range(total):
+        for i, weight in enumerate(weights):
+            current[i] += weight
+        chosen = max(range(len(weights)), key=lambda i: current[i])
+        current[chosen] -= total
+        schedule.append(chosen)
+    return tuple(schedule)
+
+
+def choose_account(accounts: list) -> MerchantAccount:
+    """
+    Returns the account whose turn it is, the turns are counted in the cache
+    so all the workers share the same rotation.
+    """
+    if len(accounts) == 1:
+        return accounts[0]
+
+    key = 'pretix_qpaypro_account_turn_{}'.format(
+        hashlib.sha1('|'.join(account.x_login for account in accounts).encode()).hexdigest()[:16]
+    )
+    cache.add(key, 0, None)
+    try:
+        turn = cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+        turn = 1
+
+    schedule = get_schedule(tuple(account.weight for account in accounts))
+    return accounts[schedule[turn % len(schedule)]]
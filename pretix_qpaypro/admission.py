@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import random
+import time
+
+from django.core.cache import cache
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+from .metrics import qpaypro_admission_queue
+
+# Seconds a call waits for its turn when none is configured
+DEFAULT_MAX_WAIT = 10
+
+POLL_INTERVAL = 0.05
+
+# Extra seconds a slot outlives the longest possible call, so the slot of a
+# worker that died is given back eventually
+SLOT_MARGIN = 30
+
+# Seconds the queue counter lives, it starts over if it ever drifts
+QUEUE_TIMEOUT = 300
+
+
+class AdmissionTimeout(Exception):
+    pass
+
+
+class AdmissionController:
+    """
+    Caps the calls all the workers send to QPayPro for one merchant account,
+    both the ones in flight at the same time and the ones started per
+    second. Calls over the limits wait for their turn up to ``max_wait``
+    seconds. Everything is kept in the Django cache.
+
+    In-flight calls hold one of ``max_in_flight`` slot keys, the per second
+    limit is a counter per second.
+    """
+
+    def __init__(self, endpoint: str, x_login: str, max_in_flight: int = None, max_rate: int = None,
+                 max_wait: float = None, call_timeout: float = 0):
+        self.account = x_login
+        self.key = 'pretix_qpaypro_admission_{}_{}'.format(
+            endpoint, hashlib.sha1(x_login.encode()).hexdigest()[:12],
+        )
+        self.max_in_flight = max_in_flight
+        self.max_rate = max_rate
+        self.max_wait = max_wait or DEFAULT_MAX_WAIT
+        self.slot_timeout = int(call_timeout) + SLOT_MARGIN
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_in_flight or self.max_rate)
+
+    @property
+    def _queue_key(self):
+        return self.key + '_queue'
+
+    def _take_slot(self):
+        if not self.max_in_flight:
+            return True
+        # Random order so waiting workers don't all fight for the first slot
+        slots = list(range(self.max_in_flight))
+        random.shuffle(slots)
+        for slot in slots:
+            slot_key = '{}_slot_{}'.format(self.key, slot)
+            if cache.add(slot_key, 1, self.slot_timeout):
+                return slot_key
+        return None
+
+    def _take_rate(self) -> bool:
+        if not self.max_rate:
+            return True
+        rate_key = '{}_rate_{}'.format(self.key, int(time.time()))
+        cache.add(rate_key, 0, 5)
+        try:
+            return cache.incr(rate_key) <= self.max_rate
+        except ValueError:
+            cache.set(rate_key, 1, 5)
+            return True
+
+    def try_acquire(self):
+        """
+        Returns the slot taken, or None if the call has to wait.
+        """
+        slot = self._take_slot()
+        if not slot:
+            return None
+        if not self._take_rate():
+            self.release(slot)
+            return None
+        return slot
+
+    def release(self, slot):
+        if slot and slot is not True:
+            cache.delete(slot)
+
+    def _queue(self, delta: int):
+        cache.add(self._queue_key, 0, QUEUE_TIMEOUT)
+        try:
+            depth = cache.incr(self._queue_key, delta)
+        except ValueError:
+            depth = max(delta, 0)
+        qpaypro_admission_queue.set(max(depth, 0), account=self.account)
+
+    def acquire(self):
+        if not self.enabled:
+            return True
+        slot = self.try_acquire()
+        if slot:
+            return slot
+
+        deadline = time.monotonic() + self.max_wait
+        self._queue(1)
+        try:
+            while time.monotonic() < deadline:
+                time.sleep(POLL_INTERVAL * (1 + random.random()))
+                slot = self.try_acquire()
+                if slot:
+                    return slot
+        finally:
+            self._queue(-1)
+        raise AdmissionTimeout('No room for a QPayPro call after {} seconds'.format(self.max_wait))
+
+    async def acquire_async(self):
+        if not self.enabled:
+            return True
+        # The cache may block on the network, it's only used from a thread
+        try_acquire = sync_to_async(self.try_acquire, thread_sensitive=False)
+        queue = sync_to_async(self._queue, thread_sensitive=False)
+        slot = await try_acquire()
+        if slot:
+            return slot
+
+        deadline = time.monotonic() + self.max_wait
+        await queue(1)
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(POLL_INTERVAL * (1 + random.random()))
+                slot = await try_acquire()
+                if slot:
+                    return slot
+        finally:
+            await queue(-1)
+        raise AdmissionTimeout('No room for a QPayPro call after {} seconds'.format(self.max_wait))
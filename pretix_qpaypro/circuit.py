@@ -0,0 +1,131 @@
+import logging
+import time
+
+from django.core.cache import cache
+from django.utils.crypto import get_random_string
+
+logger = logging.getLogger(__name__)
+
+# Calls are counted in buckets of this many seconds, the current and the
+# previous bucket make up the window the failure ratio is computed on
+WINDOW = 60
+
+# The circuit opens once the window has at least MIN_CALLS calls and at
+# least FAILURE_RATIO of them failed or took longer than SLOW_CALL
+MIN_CALLS = 10
+FAILURE_RATIO = 0.5
+SLOW_CALL = 15
+
+# Seconds the circuit stays open before a single probe is let through
+OPEN_TIME = 30
+PROBE_TIMEOUT = 60
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Tracks the failures and slow calls to a QPayPro endpoint in the Django
+    cache, so all the workers stop calling it at once while it's degraded.
+
+    closed: calls go through and are counted.
+    open: calls fail right away until OPEN_TIME has passed.
+    half-open: one probe goes through, it closes the circuit on success and
+    opens it again on failure.
+    """
+
+    def __init__(self, endpoint: str):
+        self.key = 'pretix_qpaypro_circuit_{}'.format(endpoint)
+        self.probe_token = None
+
+    @property
+    def _open_key(self):
+        return self.key + '_open_until'
+
+    @property
+    def _probe_key(self):
+        return self.key + '_probe'
+
+    def _bucket_keys(self):
+        bucket = int(time.time() // WINDOW)
+        return (
+            '{}_{}_calls'.format(self.key, bucket),
+            '{}_{}_failures'.format(self.key, bucket),
+            '{}_{}_calls'.format(self.key, bucket - 1),
+            '{}_{}_failures'.format(self.key, bucket - 1),
+        )
+
+    def _incr(self, key):
+        cache.add(key, 0, WINDOW * 2)
+        try:
+            return cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, WINDOW * 2)
+            return 1
+
+    def _open(self):
+        logger.warning('QPayPro circuit opened for %s' % self.key)
+        # Kept longer than OPEN_TIME so the next call knows it has to probe
+        cache.set(self._open_key, time.time() + OPEN_TIME, OPEN_TIME * 10)
+        cache.delete(self._probe_key)
+
+    @property
+    def is_open(self) -> bool:
+        return cache.get(self._open_key, 0) > time.time()
+
+    def allow_request(self) -> bool:
+        open_until = cache.get(self._open_key)
+        if open_until is None:
+            return True
+        if open_until > time.time():
+            return False
+        # Half-open, only the first caller gets to probe
+        token = get_random_string(16)
+        if cache.add(self._probe_key, token, PROBE_TIMEOUT):
+            self.probe_token = token
+            return True
+        return False
+
+    def _is_probe(self, open_until: float) -> bool:
+        return bool(
+            open_until <= time.time()
+            and self.probe_token
+            and cache.get(self._probe_key) == self.probe_token
+        )
+
+    def record_success(self, duration: float):
+        if duration >= SLOW_CALL:
+            self.record_failure()
+            return
+        open_until = cache.get(self._open_key)
+        if open_until is not None:
+            if not self._is_probe(open_until):
+                # A call that started before the circuit opened, only the
+                # probe gets to close it
+                return
+            logger.info('QPayPro circuit closed for %s' % self.key)
+            # The failures that opened it are forgotten as well
+            cache.delete_many([self._open_key, self._probe_key] + list(self._bucket_keys()))
+        self._incr(self._bucket_keys()[0])
+
+    def record_failure(self):
+        open_until = cache.get(self._open_key)
+        if open_until is not None and self._is_probe(open_until):
+            # The probe failed
+            self._open()
+            return
+
+        calls_key, failures_key, previous_calls_key, previous_failures_key = self._bucket_keys()
+        self._incr(calls_key)
+        self._incr(failures_key)
+        if open_until is not None:
+            # A call that started before the circuit opened, it's counted but
+            # only the probe decides when the circuit opens or closes again
+            return
+        counts = cache.get_many([calls_key, failures_key, previous_calls_key, previous_failures_key])
+        calls = counts.get(calls_key, 0) + counts.get(previous_calls_key, 0)
+        failures = counts.get(failures_key, 0) + counts.get(previous_failures_key, 0)
+        if calls >= MIN_CALLS and failures >= calls * FAILURE_RATIO:
+            self._open()
@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import tracing
+from .simulator import GatewaySimulator
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    from asgiref.sync import SyncToAsync
+except ImportError:
+    SyncToAsync = None
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT_URLS = {
+    'live': 'https://payments.qpaypro.com/checkout/api_v1',
+    'sandbox': 'https://sandbox.qpaypro.com/payment/api_v1',
+}
+
+# Default timeouts (in seconds) used when none are configured
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+
+# Connections kept alive per endpoint and per process
+POOL_MAXSIZE = 20
+
+# Only failures while connecting are retried, at that point the request never
+# reached QPayPro so repeating it can't produce a second charge
+CONNECT_RETRIES = 2
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+_simulators = {}
+
+# Errors raised by the transports when QPayPro couldn't be reached or answered
+# with an HTTP error status
+TRANSPORT_ERRORS = (requests.RequestException,) + ((httpx.HTTPError,) if httpx is not None else ())
+
+
+def _build_session() -> requests.Session:
+    retry = Retry(
+        total=CONNECT_RETRIES,
+        connect=CONNECT_RETRIES,
+        read=0,
+        status=0,
+        redirect=0,
+        backoff_factor=0.2,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session(endpoint: str) -> requests.Session:
+    # The process id is part of the key so forked workers never share the
+    # sockets of a session created in their parent
+    key = (os.getpid(), endpoint)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = _build_session()
+    return session
+
+
+def get_timeout(connect_timeout=None, read_timeout=None) -> tuple:
+    return (
+        connect_timeout or DEFAULT_CONNECT_TIMEOUT,
+        read_timeout or DEFAULT_READ_TIMEOUT,
+    )
+
+
+def async_available() -> bool:
+    return httpx is not None
+
+
+def has_long_lived_loop() -> bool:
+    """
+    Whether sync code runs under an event loop that outlives the request, as
+    under ASGI where async_to_sync goes back to the server's loop. Under WSGI
+    async_to_sync starts and closes a loop per call, the async clients would
+    never be reused and their connections never closed.
+    """
+    if SyncToAsync is None:
+        return False
+    loop = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+    return loop is not None and loop.is_running() and not loop.is_closed()
+
+
+def _build_async_client() -> 'httpx.AsyncClient':
+    # httpx only retries failed connection attempts, same as the sync session
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=POOL_MAXSIZE, max_keepalive_connections=POOL_MAXSIZE),
+        transport=httpx.AsyncHTTPTransport(retries=CONNECT_RETRIES),
+    )
+
+
+def get_async_client(endpoint: str) -> 'httpx.AsyncClient':
+    # Async clients are bound to the event loop they were created in
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    async_client = clients.get(endpoint)
+    if async_client is None:
+        async_client = clients[endpoint] = _build_async_client()
+    return async_client
+
+
+class HttpTransport:
+    """
+    Sends api_v1 requests to a QPayPro URL over the shared connection pools.
+    """
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+
+    @property
+    def key(self) -> str:
+        # Identifies the endpoint in cache keys, e.g. for its circuit breaker
+        if self.name in ENDPOINT_URLS:
+            return self.name
+        return '{}_{}'.format(self.name, hashlib.sha1(self.url.encode()).hexdigest()[:12])
+
+    def post(self, payload: dict, timeout: tuple = None) -> requests.Response:
+        return get_session(self.url).post(
+            self.url,
+            json=payload,
+            headers=tracing.inject_headers(),
+            timeout=timeout or get_timeout(),
+        )
+
+    async def post_async(self, payload: dict, timeout: tuple = None) -> 'httpx.Response':
+        connect_timeout, read_timeout = timeout or get_timeout()
+        return await get_async_client(self.url).post(
+            self.url,
+            json=payload,
+            headers=tracing.inject_headers(),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+
+
+class SimulatedResponse:
+    """
+    The parts of ``requests.Response`` the provider reads, for answers that
+    come from the simulator.
+    """
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{} Server Error from the QPayPro simulator'.format(self.status_code),
+                                     response=self)
+
+
+class SimulatorTransport:
+    """
+    Answers api_v1 requests in process through a ``GatewaySimulator``, to load
+    test an event without reaching QPayPro. A latency longer than the read
+    timeout ends in a read timeout, as it would with the real gateway.
+    """
+
+    name = key = 'simulator'
+
+    def __init__(self, simulator: GatewaySimulator):
+        self.simulator = simulator
+
+    def _get_wait(self, timeout: tuple) -> float:
+        read_timeout = (timeout or get_timeout())[1]
+        return min(self.simulator.latency, read_timeout)
+
+    def _respond(self, payload: dict, timeout: tuple) -> SimulatedResponse:
+        if self.simulator.latency > (timeout or get_timeout())[1]:
+            raise requests.ReadTimeout('The QPayPro simulator did not answer in time')
+        return SimulatedResponse(*self.simulator.respond(payload))
+
+    def post(self, payload: dict, timeout: tuple = None) -> SimulatedResponse:
+        time.sleep(self._get_wait(timeout))
+        return self._respond(payload, timeout)
+
+    async def post_async(self, payload: dict, timeout: tuple = None) -> SimulatedResponse:
+        await asyncio.sleep(self._get_wait(timeout))
+        return self._respond(payload, timeout)
+
+
+def get_simulator(latency: float = 0.0, decline_ratio: float = 0.0, error_ratio: float = 0.0) -> GatewaySimulator:
+    # One simulator per configuration and process, shared by its threads
+    key = (latency, decline_ratio, error_ratio)
+    simulator = _simulators.get(key)
+    if simulator is None:
+        simulator = _simulators.setdefault(key, GatewaySimulator(latency, decline_ratio, error_ratio))
+    return simulator
+
+
+def get_transport(endpoint: str, custom_url: str = None, simulator: GatewaySimulator = None):
+    """
+    Returns the transport for an ``x_endpoint`` setting: one of the QPayPro
+    endpoints, a custom base URL (e.g. a proxy or a simulator running as its
+    own service) or the in-process simulator.
+    """
+    if endpoint == 'simulator':
+        return SimulatorTransport(simulator or get_simulator())
+    if endpoint == 'custom':
+        if not custom_url:
+            raise ValueError('A custom QPayPro endpoint needs a URL')
+        return HttpTransport('custom', custom_url)
+    if endpoint == 'live':
+        return HttpTransport('live', ENDPOINT_URLS['live'])
+    return HttpTransport('sandbox', ENDPOINT_URLS['sandbox'])
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+
+from django.core.cache import cache
+from pretix.base.models import Event
+from pretix.base.settings import SettingsSandbox
+
+from . import tracing
+from .accounts import MerchantAccount, parse_accounts
+from .installments import (
+    build_installment_bands, parse_bins, parse_installment_plans,
+)
+
+PROVIDERS = ('qpaypro_creditcard', 'qpaypro_visaencuotas')
+
+# All of them need to be set globally for the general settings to be used
+GENERAL_REQUIRED_KEYS = (
+    'x_login',
+    'x_private_key',
+    'x_api_secret',
+    'x_endpoint',
+    'x_org_id',
+    'x_country',
+    'x_state',
+    'x_city',
+    'x_address',
+)
+
+# Keys read from the general settings when those were provided, otherwise
+# from the event settings
+SETTINGS_KEYS = OrderedDict([
+    ('x_login', str),
+    ('x_private_key', str),
+    ('x_api_secret', str),
+    ('x_accounts', str),
+    ('x_endpoint', str),
+    ('x_custom_url', str),
+    ('x_org_id', str),
+    ('x_country', str),
+    ('x_state', str),
+    ('x_city', str),
+    ('x_zip', str),
+    ('x_address', str),
+    ('x_timeout_connect', int),
+    ('x_timeout_read', int),
+    ('x_async_transport', bool),
+    ('x_background_authorization', bool),
+    ('x_deferred_refunds', bool),
+    ('x_circuit_hide', bool),
+    ('x_max_in_flight', int),
+    ('x_max_rate', int),
+    ('x_admission_wait', int),
+    ('x_simulator_latency', int),
+    ('x_simulator_decline_ratio', int),
+    ('x_simulator_error_ratio', int),
+])
+
+# Keys that always come from the event settings
+EVENT_KEYS = OrderedDict([
+    ('_enabled', bool),
+    ('method_creditcard', bool),
+    ('method_visaencuotas', bool),
+    ('visaencuotas_plans', str),
+    ('visaencuotas_bins', str),
+])
+
+CACHE_TIMEOUT = 60
+VERSION_CACHE_KEY = 'pretix_qpaypro_settings_version'
+
+
+class ResolvedSettings:
+    """
+    Snapshot of the QPayPro settings of an event, with the decision between
+    the general and the event settings already taken.
+    """
+
+    def __init__(self, settings: SettingsSandbox):
+        self.general = all(
+            settings.get('general_{}'.format(key))
+            for key in GENERAL_REQUIRED_KEYS
+        )
+        prefix = 'general_' if self.general else ''
+        for key, as_type in SETTINGS_KEYS.items():
+            setattr(self, key, settings.get(prefix + key, as_type=as_type))
+        for key, as_type in EVENT_KEYS.items():
+            setattr(self, key.lstrip('_'), settings.get(key, as_type=as_type))
+
+        # The main account first, followed by the additional ones
+        self.accounts = []
+        if self.x_login:
+            self.accounts.append(MerchantAccount(self.x_login, self.x_private_key, self.x_api_secret, 1))
+        for account in parse_accounts(self.x_accounts):
+            if all(account.x_login != known.x_login for known in self.accounts):
+                self.accounts.append(account)
+
+        # Installment plans by price band, ready for the checkout
+        self.installment_plans = parse_installment_plans(self.visaencuotas_plans)
+        self.installment_bands = build_installment_bands(self.installment_plans)
+        self.installment_bins = parse_bins(self.visaencuotas_bins)
+
+
+def get_settings_version() -> int:
+    return cache.get(VERSION_CACHE_KEY, 0)
+
+
+def invalidate_resolved_settings():
+    try:
+        cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        cache.set(VERSION_CACHE_KEY, 1, None)
+
+
+def get_resolved_settings(event: Event, settings: SettingsSandbox) -> ResolvedSettings:
+    with tracing.span('qpaypro.resolve_settings', pretix__event=event.slug):
+        key = 'pretix_qpaypro_settings_{}_{}'.format(event.pk, get_settings_version())
+        resolved = cache.get(key)
+        tracing.set_attributes(qpaypro__cache_hit=resolved is not None)
+        if resolved is None:
+            resolved = ResolvedSettings(settings)
+            cache.set(key, resolved, CACHE_TIMEOUT)
+        return resolved
@@ -0,0 +1,119 @@
+import json
+from collections import OrderedDict
+
+import pytz
+from django import forms
+from django.utils.dateparse import parse_date
+from django.utils.translation import ugettext_lazy as _
+from pretix.base.exporter import ListExporter
+from pretix.base.forms.widgets import DatePickerWidget
+from pretix.base.models import OrderPayment
+
+from .config import PROVIDERS
+
+# Payments read from the database at a time
+CHUNK_SIZE = 1000
+
+
+class QPayProTransactionsExporter(ListExporter):
+    identifier = 'qpaypro_transactions'
+    verbose_name = _('QPayPro transactions')
+
+    @property
+    def additional_form_fields(self):
+        return OrderedDict([
+            ('method', forms.ChoiceField(
+                label=_('Payment method'),
+                required=False,
+                choices=(
+                    ('', _('All')),
+                    ('creditcard', _('Credit card')),
+                    ('visaencuotas', _('Monthly payments')),
+                ),
+            )),
+            ('date_from', forms.DateField(
+                label=_('Start date'),
+                required=False,
+                widget=DatePickerWidget,
+            )),
+            ('date_to', forms.DateField(
+                label=_('End date'),
+                required=False,
+                widget=DatePickerWidget,
+            )),
+            ('response_code', forms.IntegerField(
+                label=_('Response code'),
+                required=False,
+            )),
+        ])
+
+    def get_filename(self):
+        return '{}_qpaypro'.format(self.event.slug)
+
+    def get_queryset(self, form_data):
+        qs = OrderPayment.objects.filter(order__event=self.event, provider__in=PROVIDERS)
+
+        if form_data.get('method'):
+            qs = qs.filter(provider='qpaypro_{}'.format(form_data['method']))
+
+        # Dates come back as strings when the export runs in a worker
+        date_from, date_to = form_data.get('date_from'), form_data.get('date_to')
+        if date_from:
+            qs = qs.filter(created__date__gte=parse_date(str(date_from)))
+        if date_to:
+            qs = qs.filter(created__date__lte=parse_date(str(date_to)))
+
+        # Narrowed down by the database, checked again on the parsed info
+        if form_data.get('response_code') is not None:
+            qs = qs.filter(info__contains='"responseCode": {}'.format(form_data['response_code']))
+
+        return qs.order_by('pk').values_list(
+            'order__code', 'local_id', 'provider', 'state', 'created', 'payment_date', 'amount', 'info',
+        )
+
+    def iterate_list(self, form_data):
+        tz = pytz.timezone(self.event.settings.timezone)
+        states = dict(OrderPayment.PAYMENT_STATES)
+        response_code = form_data.get('response_code')
+
+        yield [
+            _('Order code'),
+            _('Payment ID'),
+            _('Payment method'),
+            _('Payment state'),
+            _('Creation date'),
+            _('Payment date'),
+            _('Amount'),
+            _('Result'),
+            _('Response code'),
+            _('Response text'),
+            _('QPayPro response'),
+        ]
+
+        # Rows are read in chunks and turned into lines one at a time, so the
+        # memory used doesn't grow with the size of the event
+        for code, local_id, provider, state, created, payment_date, amount, info in self.get_queryset(
+                form_data).iterator(chunk_size=CHUNK_SIZE):
+            try:
+                data = json.loads(info) if info else {}
+            except ValueError:
+                data = {}
+            if not isinstance(data, dict):
+                data = {}
+
+            if response_code is not None and data.get('responseCode') != response_code:
+                continue
+
+            yield [
+                code,
+                '{}-P-{}'.format(code, local_id),
+                provider.replace('qpaypro_', ''),
+                states.get(state, state),
+                created.astimezone(tz).strftime('%Y-%m-%d %H:%M:%S'),
+                payment_date.astimezone(tz).strftime('%Y-%m-%d %H:%M:%S') if payment_date else '',
+                amount,
+                data.get('result', ''),
+                data.get('responseCode', ''),
+                data.get('responseText', ''),
+                info or '',
+            ]
@@ -6,6 +6,17 @@ from django import forms
 from django.forms.widgets import TextInput
 from django.utils.translation import ugettext_lazy as _
 
+from ..accounts import parse_accounts
+from ..installments import parse_bins, parse_installment_plans
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Sum of the digits of each digit once doubled, as used by the Luhn algorithm
+LUHN_DOUBLED = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+
 
 class TelephoneInput(TextInput):
 
@@ -13,6 +24,19 @@ class TelephoneInput(TextInput):
     input_type = 'tel'
 
 
+def build_prefix_table(cards):
+    # Maps every card number prefix to its card, with the lengths turned into
+    # sets so they can be checked in constant time
+    table = {}
+    for card in cards:
+        spec = dict(card)
+        spec['length'] = frozenset(card['length'])
+        spec['cvvLength'] = frozenset(card['cvvLength'])
+        for pattern in card['patterns']:
+            table.setdefault(str(pattern), spec)
+    return table
+
+
 class CreditCardField(forms.CharField):
 
     # validates almost all of the example cards from PayPal
@@ -81,6 +105,10 @@ class CreditCardField(forms.CharField):
         }
     ]
 
+    # Prefix lookup table built once from the cards, see card_from_number
+    prefix_table = build_prefix_table(cards)
+    prefix_max_length = max(len(prefix) for prefix in prefix_table)
+
     def __init__(self, placeholder=None, *args, **kwargs):
         super(CreditCardField, self).__init__(
             # override default widget
@@ -97,43 +125,141 @@ class CreditCardField(forms.CharField):
     def clean(self, value):
 
         # ensure no spaces or dashes
-        value = value.replace(' ', '').replace('-', '')
-
-        # get the card type and its specs
-        card = self.card_from_number(value)
-
-        # if no card found, invalid
-        if not card:
-            raise forms.ValidationError(self.error_messages['invalid'])
+        value = normalize_card_number(value)
 
-        # check the length
-        if not len(value) in card['length']:
+        # get the card type and check its length and luhn if necessary
+        card, length_valid, luhn_valid = check_card_number(value)
+        if not (card and length_valid and luhn_valid):
             raise forms.ValidationError(self.error_messages['invalid'])
 
-        # test luhn if necessary
-        if card['luhn']:
-            if not self.validate_mod10(value):
-                raise forms.ValidationError(self.error_messages['invalid'])
-
         return value
 
-    def card_from_number(self, num):
-        # find this card, based on the card number, in the defined set of cards
-        for card in self.cards:
-            for pattern in card['patterns']:
-                if (str(pattern) == str(num)[:len(str(pattern))]):
-                    return card
+    @classmethod
+    def prefix_types(cls):
+        # card type of every known prefix, e.g. to detect it on the client
+        return {prefix: card['type'] for prefix, card in cls.prefix_table.items()}
+
+    @classmethod
+    def card_from_number(cls, num):
+        # find this card, based on the card number, using the longest known
+        # prefix of the number
+        num = str(num)
+        for length in range(min(len(num), cls.prefix_max_length), 0, -1):
+            card = cls.prefix_table.get(num[:length])
+            if card:
+                return card
 
-    def validate_mod10(self, num):
-        # validate card number using the Luhn (mod 10) algorithm
-        checksum, factor = 0, 1
+    @staticmethod
+    def validate_mod10(num):
+        # validate card number using the Luhn (mod 10) algorithm, every second
+        # digit from the right is looked up already doubled and summed
+        checksum, doubled = 0, False
         for c in reversed(num):
-            for c in str(factor * int(c)):
-                checksum += int(c)
-            factor = 3 - factor
+            digit = ord(c) - 48
+            if not 0 <= digit <= 9:
+                return False
+            checksum += LUHN_DOUBLED[digit] if doubled else digit
+            doubled = not doubled
         return checksum % 10 == 0
 
 
+def normalize_card_number(value: str):
+    return value.replace(' ', '').replace('-', '')
+
+
+def check_card_number(value: str):
+    """
+    Returns the card of an already normalized number, whether its length is
+    valid for that card and whether it passes the Luhn check (always True for
+    cards that don't use it).
+    """
+    card = CreditCardField.card_from_number(value)
+    if not card:
+        return None, False, False
+    length_valid = len(value) in card['length']
+    luhn_valid = not card['luhn'] or CreditCardField.validate_mod10(value)
+    return card, length_valid, luhn_valid
+
+
+def _validate_mod10_many(numbers):
+    # Digits of every number in a matrix, reversed and padded with zeros at
+    # the end so the check digit is always in the first column
+    width = max(len(num) for num in numbers)
+    ascii_numbers = [num if num.isascii() else '' for num in numbers]
+    digits = np.frombuffer(
+        ''.join(num[::-1].ljust(width, '0') for num in ascii_numbers).encode('ascii'),
+        dtype=np.uint8,
+    ).reshape(len(numbers), width) - ord('0')
+
+    # Anything other than 0-9 wrapped around the unsigned subtraction
+    is_digit = (digits <= 9).all(axis=1) & (np.array([len(num) for num in ascii_numbers]) > 0)
+    digits = np.where(digits <= 9, digits, 0)
+
+    checksum = digits[:, 0::2].sum(axis=1) + np.array(LUHN_DOUBLED, dtype=np.uint16)[digits[:, 1::2]].sum(axis=1)
+    return is_digit & (checksum % 10 == 0)
+
+
+def validate_card_numbers(numbers):
+    """
+    Validates many card numbers at once, with the same rules as
+    ``CreditCardField.clean``. Returns three arrays with the card type of each
+    number (``None`` if unknown), whether its length is valid for that type and
+    whether it passes the Luhn check. NumPy arrays are returned when NumPy is
+    installed, plain lists otherwise.
+    """
+    numbers = [normalize_card_number(str(num)) for num in numbers]
+
+    if np is None:
+        results = [check_card_number(num) for num in numbers]
+        return (
+            [card['type'] if card else None for card, length_valid, luhn_valid in results],
+            [length_valid for card, length_valid, luhn_valid in results],
+            [luhn_valid for card, length_valid, luhn_valid in results],
+        )
+
+    if not numbers:
+        # Same types as below, the checksum needs at least one number
+        return np.array([], dtype=object), np.array([], dtype=bool), np.array([], dtype=bool)
+
+    cards = [CreditCardField.card_from_number(num) for num in numbers]
+    types = np.array([card['type'] if card else None for card in cards], dtype=object)
+    length_valid = np.array([bool(card) and len(num) in card['length'] for card, num in zip(cards, numbers)],
+                            dtype=bool)
+    uses_luhn = np.array([bool(card) and card['luhn'] for card in cards], dtype=bool)
+    luhn_valid = np.array([bool(card) for card in cards], dtype=bool) & (~uses_luhn | _validate_mod10_many(numbers))
+    return types, length_valid, luhn_valid
+
+
+def validate_merchant_accounts(value):
+    try:
+        parse_accounts(value, strict=True)
+    except ValueError as e:
+        raise forms.ValidationError(
+            _('Line %(line)s is not a valid account, use "login,private key,api secret,weight".'),
+            params={'line': e.args[0]},
+        )
+
+
+def validate_installment_plans(value):
+    try:
+        parse_installment_plans(value, strict=True)
+    except ValueError as e:
+        raise forms.ValidationError(
+            _('"%(plan)s" is not a valid plan, use "months:minimum amount" with at least 2 months.'),
+            params={'plan': e.args[0]},
+        )
+
+
+def validate_bins(value):
+    try:
+        parse_bins(value, strict=True)
+    except ValueError as e:
+        raise forms.ValidationError(
+            _('"%(bin)s" is not a valid card number prefix.'),
+            params={'bin': e.args[0]},
+        )
+
+
 # This method is used to mask a CC number for display
 def mask_cc_number(cc_number: str):
     return cc_number[-4:].rjust(len(cc_number), "*")
@@ -1,14 +1,55 @@
+import copy
 import datetime
+from functools import lru_cache
 
 from django import forms
+from django.utils import translation
+from django.utils.text import format_lazy
 from django.utils.translation import ugettext_lazy as _
+from pretix.base.templatetags.money import money_filter
 
 from .custom_validators import CreditCardField
 
-now = datetime.datetime.now()
-
 
 def get_payment_form_fields():
+    # The fields are built once per year and cloned for every form, which is
+    # cheaper than building them again and never shares state between forms
+    year = datetime.date.today().year
+    return [(name, copy.deepcopy(field)) for name, field in _get_payment_form_prototypes(year)]
+
+
+@lru_cache(maxsize=2)
+def _get_payment_form_prototypes(year):
+    return tuple(build_payment_form_fields(year))
+
+
+def get_installments_field(plans, currency):
+    # Built once per plan table, currency and language, cloned for every form
+    return copy.deepcopy(_get_installments_field_prototype(plans, currency, translation.get_language()))
+
+
+@lru_cache(maxsize=32)
+def _get_installments_field_prototype(plans, currency, language):
+    return build_installments_field(plans, currency)
+
+
+def build_installments_field(plans, currency):
+    choices = []
+    for months, min_amount in plans:
+        if min_amount:
+            label = format_lazy(_('{months} monthly payments, for orders from {amount}'), months=months,
+                                amount=money_filter(min_amount, currency))
+        else:
+            label = format_lazy(_('{months} monthly payments'), months=months)
+        choices.append((str(months), label))
+    return forms.ChoiceField(
+        label=_('Monthly Payments'),
+        required=True,
+        choices=choices,
+    )
+
+
+def build_payment_form_fields(year):
     return [
         (
             'cc_type',
@@ -46,9 +87,9 @@ def get_payment_form_fields():
             forms.IntegerField(
                 label=_('Expiration Year'),
                 required=True,
-                max_value=now.year + 10,
-                min_value=now.year,
-                help_text=_('The full year should be provided, for example {0}.'.format(now.year)),
+                max_value=year + 10,
+                min_value=year,
+                help_text=format_lazy(_('The full year should be provided, for example {0}.'), year),
             )
         ),
         (
@@ -1,8 +1,24 @@
+import copy
+from functools import lru_cache
+
 from django import forms
+from django.utils.text import format_lazy
 from django.utils.translation import ugettext_lazy as _
 
+from .custom_validators import validate_merchant_accounts
+
 
 def get_settings_form_fields(prefix, required):
+    # The fields are built once and cloned for every form
+    return [(name, copy.deepcopy(field)) for name, field in _get_settings_form_prototypes(prefix, required)]
+
+
+@lru_cache(maxsize=None)
+def _get_settings_form_prototypes(prefix, required):
+    return tuple(build_settings_form_fields(prefix, required))
+
+
+def build_settings_form_fields(prefix, required):
     return [
         (
             '{prefix}x_login'.format(
@@ -11,7 +27,9 @@ def get_settings_form_fields(prefix, required):
             forms.CharField(
                 label=_('QPayPro: Login'),
                 required=required,
-                help_text='{text1} <a target="_blank" rel="noopener" href="{docs_url}">{text2}</a>'.format(
+                # Lazy, the prototype is shared by admins with any language
+                help_text=format_lazy(
+                    '{text1} <a target="_blank" rel="noopener" href="{docs_url}">{text2}</a>',
                     text1=_('Also referred to as \"Public Key\".'),
                     text2=_('Click here to access the API information.'),
                     docs_url='https://qpaypro.zendesk.com/hc/es/articles/115001625892-Manual-de-integración-de-pago-QPayPro-via-API-V1-0'
@@ -41,6 +59,20 @@ def get_settings_form_fields(prefix, required):
                 min_length=11,
             )
         ),
+        (
+            '{prefix}x_accounts'.format(
+                prefix=prefix
+            ),
+            forms.CharField(
+                label=_('QPayPro: Additional Accounts'),
+                required=False,
+                widget=forms.Textarea(attrs={'rows': 3}),
+                validators=[validate_merchant_accounts],
+                help_text=_('Payments are spread over the account above and these ones, one per line as '
+                            '"login,private key,api secret,weight". The weight is optional and defaults to 1, '
+                            'as the one of the account above.'),
+            )
+        ),
         (
             '{prefix}x_endpoint'.format(
                 prefix=prefix
@@ -52,7 +84,21 @@ def get_settings_form_fields(prefix, required):
                 choices=(
                     ('sandbox', _('Sandbox')),
                     ('live', _('Live')),
+                    ('custom', _('Custom URL')),
+                    ('simulator', _('Simulator (test mode only)')),
                 ),
+                help_text=_('The simulator answers payments without contacting QPayPro, for load tests. It is only '
+                            'used while the shop is in test mode.'),
+            )
+        ),
+        (
+            '{prefix}x_custom_url'.format(
+                prefix=prefix
+            ),
+            forms.URLField(
+                label=_('QPayPro: Custom URL'),
+                required=False,
+                help_text=_('Full URL of the api_v1 endpoint, only used with the "Custom URL" endpoint.'),
             )
         ),
         (
@@ -64,7 +110,8 @@ def get_settings_form_fields(prefix, required):
                 required=required,
                 max_length=8,
                 min_length=8,
-                help_text='{text1} <a target="_blank" rel="noopener" href="{docs_url}">{text2}</a>'.format(
+                help_text=format_lazy(
+                    '{text1} <a target="_blank" rel="noopener" href="{docs_url}">{text2}</a>',
                     text1=_('Required to generate client device fingerprint.'),
                     text2=_('Click here to access the associated documentation.'),
                     docs_url='https://qpaypro.zendesk.com/hc/es/articles/115002159651-Device-Fingerprint'
@@ -116,4 +163,148 @@ def get_settings_form_fields(prefix, required):
                 required=required,
             )
         ),
+        (
+            '{prefix}x_timeout_connect'.format(
+                prefix=prefix
+            ),
+            forms.IntegerField(
+                label=_('QPayPro: Connection Timeout'),
+                required=False,
+                min_value=1,
+                max_value=60,
+                help_text=_('Seconds to wait while connecting to QPayPro. Defaults to 5 seconds.'),
+            )
+        ),
+        (
+            '{prefix}x_timeout_read'.format(
+                prefix=prefix
+            ),
+            forms.IntegerField(
+                label=_('QPayPro: Response Timeout'),
+                required=False,
+                min_value=1,
+                max_value=300,
+                help_text=_('Seconds to wait for QPayPro to answer a payment request. Defaults to 60 seconds.'),
+            )
+        ),
+        (
+            '{prefix}x_async_transport'.format(
+                prefix=prefix
+            ),
+            forms.BooleanField(
+                label=_('QPayPro: Asynchronous requests'),
+                required=False,
+                help_text=_('Send payments through a non-blocking client, recommended for ASGI deployments. '
+                            'Requires the "httpx" package to be installed. Under WSGI the regular connection '
+                            'pool is used.'),
+            )
+        ),
+        (
+            '{prefix}x_background_authorization'.format(
+                prefix=prefix
+            ),
+            forms.BooleanField(
+                label=_('QPayPro: Authorize in background'),
+                required=False,
+                help_text=_('Payments are sent to QPayPro by a background worker while the customer waits on a '
+                            'status page, so a slow gateway never blocks the checkout.'),
+            )
+        ),
+        (
+            '{prefix}x_deferred_refunds'.format(
+                prefix=prefix
+            ),
+            forms.BooleanField(
+                label=_('QPayPro: Deferred refunds'),
+                required=False,
+                help_text=_('Refunds are not sent when they are created but left waiting for the "qpaypro_refund" '
+                            'command, e.g. to send the refunds of a cancelled event in bulk.'),
+            )
+        ),
+        (
+            '{prefix}x_circuit_hide'.format(
+                prefix=prefix
+            ),
+            forms.BooleanField(
+                label=_('QPayPro: Hide while unavailable'),
+                required=False,
+                help_text=_('Payments fail right away while QPayPro is failing or too slow. With this option the '
+                            'payment methods are also hidden during that time so customers can choose another one.'),
+            )
+        ),
+        (
+            '{prefix}x_max_in_flight'.format(
+                prefix=prefix
+            ),
+            forms.IntegerField(
+                label=_('QPayPro: Concurrent Requests'),
+                required=False,
+                min_value=1,
+                max_value=1000,
+                help_text=_('Most requests sent to QPayPro at the same time by all the servers, per merchant '
+                            'account. Leave empty for no limit.'),
+            )
+        ),
+        (
+            '{prefix}x_max_rate'.format(
+                prefix=prefix
+            ),
+            forms.IntegerField(
+                label=_('QPayPro: Requests per Second'),
+                required=False,
+                min_value=1,
+                max_value=1000,
+                help_text=_('Most requests sent to QPayPro per second by all the servers, per merchant account. '
+                            'Leave empty for no limit.'),
+            )
+        ),
+        (
+            '{prefix}x_admission_wait'.format(
+                prefix=prefix
+            ),
+            forms.IntegerField(
+                label=_('QPayPro: Queue Timeout'),
+                required=False,
+                min_value=1,
+                max_value=120,
+                help_text=_('Seconds a payment waits for its turn while the limits above are reached before it '
+                            'fails. Defaults to 10 seconds.'),
+            )
+        ),
+        (
+            '{prefix}x_simulator_latency'.format(
+                prefix=prefix
+            ),
+            forms.IntegerField(
+                label=_('QPayPro: Simulator Latency'),
+                required=False,
+                min_value=0,
+                max_value=300000,
+                help_text=_('Milliseconds the simulator takes to answer.'),
+            )
+        ),
+        (
+            '{prefix}x_simulator_decline_ratio'.format(
+                prefix=prefix
+            ),
+            forms.IntegerField(
+                label=_('QPayPro: Simulator Declines'),
+                required=False,
+                min_value=0,
+                max_value=100,
+                help_text=_('Percentage of the payments the simulator declines.'),
+            )
+        ),
+        (
+            '{prefix}x_simulator_error_ratio'.format(
+                prefix=prefix
+            ),
+            forms.IntegerField(
+                label=_('QPayPro: Simulator Errors'),
+                required=False,
+                min_value=0,
+                max_value=100,
+                help_text=_('Percentage of the payments the simulator answers with a server error.'),
+            )
+        ),
     ]
@@ -0,0 +1,51 @@
+import json
+import time
+
+from django.core.cache import cache
+from django.utils.crypto import get_random_string, salted_hmac
+from pretix.base.models import OrderPayment
+
+# Fields that change on every call without changing the payment itself
+VOLATILE_FIELDS = ('x_fp_timestamp',)
+
+# Extra seconds the lock outlives the longest possible call to QPayPro
+LOCK_MARGIN = 30
+
+POLL_INTERVAL = 0.5
+
+
+def get_request_fingerprint(payment_body: dict) -> str:
+    # HMAC of the body, it identifies a request without revealing the card
+    data = {k: v for k, v in payment_body.items() if k not in VOLATILE_FIELDS}
+    return salted_hmac(
+        'pretix_qpaypro.idempotency',
+        json.dumps(data, sort_keys=True, default=str),
+    ).hexdigest()
+
+
+class PaymentLock:
+    """
+    Cache based lock that only lets one worker send a given payment to
+    QPayPro at a time.
+    """
+
+    def __init__(self, payment: OrderPayment, timeout: float):
+        self.key = 'pretix_qpaypro_payment_lock_{}'.format(payment.pk)
+        self.timeout = int(timeout) + LOCK_MARGIN
+        self.token = get_random_string(16)
+
+    def acquire(self) -> bool:
+        return cache.add(self.key, self.token, self.timeout)
+
+    def release(self):
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+    def wait(self, timeout: float) -> bool:
+        # Waits for whoever holds the lock, returns False if it's still held
+        deadline = time.monotonic() + timeout
+        while cache.get(self.key) is not None:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+        return True
@@ -0,0 +1,68 @@
+from bisect import bisect_right
+from decimal import Decimal, InvalidOperation
+
+
+def parse_installment_plans(text: str, strict: bool = False) -> tuple:
+    """
+    Reads the installment plans setting, one plan per line or separated by
+    commas as ``months:minimum amount``, e.g. ``3:500, 6:1000``. Returns the
+    plans as ``(months, minimum amount)`` sorted by months. Invalid plans
+    raise a ValueError with ``strict``, otherwise they are skipped.
+    """
+    plans = {}
+    for part in (text or '').replace('\n', ',').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            months, min_amount = part.split(':')
+            months, min_amount = int(months), Decimal(min_amount.strip())
+            if months < 2 or min_amount < 0:
+                raise ValueError
+        except (ValueError, InvalidOperation):
+            if strict:
+                raise ValueError(part)
+            continue
+        plans[months] = min_amount
+    return tuple(sorted(plans.items()))
+
+
+def parse_bins(text: str, strict: bool = False) -> tuple:
+    # Card number prefixes allowed to pay in installments, any if empty
+    bins = []
+    for part in (text or '').replace('\n', ',').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if not (part.isdigit() and len(part) <= 8):
+            if strict:
+                raise ValueError(part)
+            continue
+        bins.append(part)
+    return tuple(bins)
+
+
+def build_installment_bands(plans: tuple) -> tuple:
+    """
+    Precomputes the plans available from every minimum amount on, so the
+    plans for an amount are found with a single bisection. Returns the
+    sorted minimum amounts and, for each one, the months available.
+    """
+    thresholds = sorted({min_amount for months, min_amount in plans})
+    options = tuple(
+        tuple(months for months, min_amount in plans if min_amount <= threshold)
+        for threshold in thresholds
+    )
+    return tuple(thresholds), options
+
+
+def get_eligible_installments(bands: tuple, amount: Decimal) -> tuple:
+    thresholds, options = bands
+    index = bisect_right(thresholds, amount) - 1
+    if index < 0:
+        return ()
+    return options[index]
+
+
+def is_bin_eligible(bins: tuple, number: str) -> bool:
+    return not bins or str(number).startswith(bins)
@@ -0,0 +1,279 @@
+import copy
+import datetime
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, OrderPayment
+from pretix.base.payment import PaymentException
+
+from ...formfields.custom_validators import CreditCardField
+from ...formfields.payment import (
+    build_payment_form_fields, get_payment_form_fields,
+)
+from ...formfields.settings import (
+    build_settings_form_fields, get_settings_form_fields,
+)
+from ...simulator import FakeGatewayServer, GatewaySimulator
+
+SAMPLE_CARDS = [
+    '4111111111111111',
+    '4012888888881881',
+    '5555555555554444',
+    '5105105105105100',
+    '378282246310005',
+    '6011111111111117',
+]
+
+IMPORT_SCRIPT = '''
+import time
+import django
+django.setup()
+start = time.perf_counter()
+import pretix_qpaypro.payment
+print(time.perf_counter() - start)
+'''
+
+SAMPLE_SESSION = {
+    'cc_type': 'visa',
+    'cc_number': '4111111111111111',
+    'cc_exp_month': 12,
+    'cc_exp_year': 2030,
+    'cc_cvv2': 123,
+    'cc_first_name': 'John',
+    'cc_last_name': 'Doe',
+    'session_onlinemetrix': 'benchmark',
+}
+
+
+def legacy_validate_mod10(num):
+    # Luhn implementation used before the lookup table, kept for comparison
+    checksum, factor = 0, 1
+    for c in reversed(num):
+        for c in str(factor * int(c)):
+            checksum += int(c)
+        factor = 3 - factor
+    return checksum % 10 == 0
+
+
+def luhn_sample(length):
+    # A valid number of the given length, the check digit is found by brute force
+    base = ('4' * length)[:length - 1]
+    for check_digit in '0123456789':
+        if CreditCardField.validate_mod10(base + check_digit):
+            return base + check_digit
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def measure(func, iterations):
+    timings = []
+    tracemalloc.start()
+    try:
+        for i in range(iterations):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return timings, peak
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks the QPayPro payment hot path: card validation, payment body building for existing '
+            'orders and whole payments against a local fake gateway.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', nargs='+', choices=['import', 'forms', 'validation', 'luhn', 'body', 'gateway'],
+                            default=['import', 'forms', 'validation', 'luhn', 'body', 'gateway'])
+        parser.add_argument('--iterations', type=int, default=1000)
+        parser.add_argument('--event', help='Event used to benchmark the payment body, as "organizer/event"')
+        parser.add_argument('--order', nargs='*', default=[],
+                            help='Codes of the orders used to benchmark the payment body, e.g. with 1, 10 and 500 '
+                                 'positions')
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds the fake gateway waits to answer')
+        parser.add_argument('--requests', type=int, default=200, help='Payments per scenario and order')
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 10, 50])
+
+    def report(self, name, timings, peak=None, queries=None):
+        line = '{:<40} n={:<6} mean={:8.3f}ms p50={:8.3f}ms p99={:8.3f}ms'.format(
+            name,
+            len(timings),
+            statistics.mean(timings) * 1000,
+            percentile(timings, 50) * 1000,
+            percentile(timings, 99) * 1000,
+        )
+        if peak is not None:
+            line += ' peak={:.1f}KiB'.format(peak / 1024)
+        if queries is not None:
+            line += ' queries={}'.format(queries)
+        self.stdout.write(line)
+
+    def handle(self, *args, **options):
+        if 'import' in options['only']:
+            self.benchmark_import(options)
+        if 'forms' in options['only']:
+            self.benchmark_forms(options)
+        if 'validation' in options['only']:
+            self.benchmark_validation(options)
+        if 'luhn' in options['only']:
+            self.benchmark_luhn(options)
+        if 'body' in options['only']:
+            self.benchmark_body(options)
+        if 'gateway' in options['only']:
+            self.benchmark_gateway(options)
+
+    def benchmark_import(self, options):
+        self.stdout.write(self.style.MIGRATE_HEADING('Import of pretix_qpaypro.payment'))
+        # Every run is a fresh interpreter, otherwise the module is cached
+        timings = []
+        for i in range(10):
+            output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], env=os.environ.copy())
+            timings.append(float(output.decode().strip().splitlines()[-1]))
+        self.report('import', timings)
+
+    def benchmark_forms(self, options):
+        self.stdout.write(self.style.MIGRATE_HEADING('Form fields per request, cloned vs. built'))
+        year = datetime.date.today().year
+        cases = [
+            ('payment fields cloned', get_payment_form_fields),
+            ('payment fields built', lambda: build_payment_form_fields(year)),
+            ('settings fields cloned', lambda: get_settings_form_fields('payment_qpaypro_general_', False)),
+            ('settings fields built', lambda: build_settings_form_fields('payment_qpaypro_general_', False)),
+        ]
+        for name, func in cases:
+            timings, peak = measure(func, options['iterations'])
+            self.report(name, timings, peak)
+
+    def benchmark_validation(self, options):
+        field = CreditCardField()
+        self.stdout.write(self.style.MIGRATE_HEADING('CreditCardField.clean'))
+        for number in SAMPLE_CARDS:
+            timings, peak = measure(lambda: field.clean(number), options['iterations'])
+            self.report(number, timings, peak)
+
+    def benchmark_luhn(self, options):
+        self.stdout.write(self.style.MIGRATE_HEADING('Luhn check, lookup table vs. legacy'))
+        lengths = sorted({length for card in CreditCardField.cards for length in card['length']})
+        for length in lengths:
+            number = luhn_sample(length)
+            timings, peak = measure(lambda: CreditCardField.validate_mod10(number), options['iterations'])
+            self.report('table  {} digits'.format(length), timings, peak)
+            timings, peak = measure(lambda: legacy_validate_mod10(number), options['iterations'])
+            self.report('legacy {} digits'.format(length), timings, peak)
+
+    def get_event(self, options):
+        try:
+            organizer, slug = options['event'].split('/')
+            return Event.objects.get(organizer__slug=organizer, slug=slug)
+        except (ValueError, Event.DoesNotExist):
+            raise CommandError('Unknown event "{}".'.format(options['event']))
+
+    def get_payment(self, event, code):
+        order = event.orders.filter(code=code).first()
+        payment = order.payments.filter(provider__startswith='qpaypro_').last() if order else None
+        if not payment:
+            raise CommandError('Order "{}" has no QPayPro payment.'.format(code))
+        return payment
+
+    def get_card_request(self, provider):
+        request = RequestFactory().get('/')
+        request.session = {
+            provider.get_payment_key_prefix() + k: v for k, v in SAMPLE_SESSION.items()
+        }
+        # Card data is read from the vault, as after the payment step
+        provider._store_card_data(request)
+        return request
+
+    def benchmark_body(self, options):
+        self.stdout.write(self.style.MIGRATE_HEADING('_get_payment_body'))
+        if not options['event'] or not options['order']:
+            self.stdout.write('Skipped, --event and --order are required.')
+            return
+
+        with scopes_disabled():
+            event = self.get_event(options)
+            for code in options['order']:
+                payment = self.get_payment(event, code)
+                provider = payment.payment_provider
+                request = self.get_card_request(provider)
+
+                with CaptureQueriesContext(connection) as queries:
+                    provider._get_payment_body(request, payment)
+
+                iterations = max(1, options['iterations'] // 10)
+                timings, peak = measure(lambda: provider._get_payment_body(request, payment), iterations)
+                self.report('{} ({} positions)'.format(code, payment.order.positions.count()), timings, peak,
+                            len(queries.captured_queries))
+
+    def execute_payment(self, provider, payment):
+        # A new payment of the order is sent and everything it changed is
+        # rolled back afterwards, each thread has its own transaction
+        with scopes_disabled(), transaction.atomic():
+            new_payment = payment.order.payments.create(
+                provider=payment.provider,
+                amount=payment.amount,
+                state=OrderPayment.PAYMENT_STATE_CREATED,
+            )
+            request = self.get_card_request(provider)
+            start = time.perf_counter()
+            try:
+                provider.execute_payment(request, new_payment)
+            except PaymentException:
+                pass
+            duration = time.perf_counter() - start
+            transaction.set_rollback(True)
+        return duration
+
+    def benchmark_gateway(self, options):
+        self.stdout.write(self.style.MIGRATE_HEADING('execute_payment (gateway latency {}s)'.format(
+            options['latency'])))
+        if not options['event'] or not options['order']:
+            self.stdout.write('Skipped, --event and --order are required.')
+            return
+
+        with scopes_disabled():
+            event = self.get_event(options)
+            if not event.testmode:
+                raise CommandError('Payments are confirmed while they are benchmarked, the event has to be in test '
+                                   'mode.')
+            payments = [self.get_payment(event, code) for code in options['order']]
+
+        scenarios = [
+            ('success', GatewaySimulator(latency=options['latency'])),
+            ('decline', GatewaySimulator(latency=options['latency'], decline_ratio=1)),
+            ('5xx', GatewaySimulator(latency=options['latency'], error_ratio=1)),
+        ]
+        for name, simulator in scenarios:
+            with FakeGatewayServer(simulator) as server:
+                for payment in payments:
+                    # Only this provider is pointed to the fake gateway, the
+                    # settings of the event are left alone
+                    provider = payment.payment_provider
+                    provider._resolved_settings = copy.copy(provider.resolved_settings)
+                    provider._resolved_settings.x_endpoint = 'custom'
+                    provider._resolved_settings.x_custom_url = server.url
+                    provider._resolved_settings.x_background_authorization = False
+                    provider._resolved_settings.x_async_transport = False
+
+                    for concurrency in options['concurrency']:
+                        start = time.perf_counter()
+                        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                            timings = list(executor.map(lambda i: self.execute_payment(provider, payment),
+                                                        range(options['requests'])))
+                        elapsed = time.perf_counter() - start
+                        self.report('{} {} x{}'.format(name, payment.order.code, concurrency), timings)
+                        self.stdout.write('{:<40} {:.1f} payments/s'.format('', len(timings) / elapsed))
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment, Quota
+from pretix.base.payment import PaymentException
+from requests import RequestException
+
+from ...client import get_session, get_timeout
+from ...config import PROVIDERS
+from ...throttling import RateLimiter
+from ..utils import ProviderCache, add_event_argument, filter_events
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Checks QPayPro payments that are pending or whose outcome is unknown (e.g. the connection was lost '
+            'while waiting for QPayPro) against QPayPro and updates them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status-url', required=True,
+                            help='QPayPro URL that returns the api_v1 result of a transaction by its audit number')
+        add_event_argument(parser)
+        parser.add_argument('--days', type=int, default=7, help='Only payments created in the last days')
+        parser.add_argument('--min-age', type=int, default=10,
+                            help='Only payments created at least these minutes ago, so running ones are left alone')
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent requests to QPayPro')
+        parser.add_argument('--rate', type=float, default=5, help='Maximum requests per second to QPayPro')
+        parser.add_argument('--checkpoint', help='File to store the progress in, to resume an interrupted run')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def get_queryset(self, options):
+        qs = OrderPayment.objects.filter(
+            provider__in=PROVIDERS,
+            created__gte=now() - timedelta(days=options['days']),
+            created__lte=now() - timedelta(minutes=options['min_age']),
+        ).filter(
+            # Waiting for a background worker
+            Q(state=OrderPayment.PAYMENT_STATE_PENDING)
+            # The call never finished
+            | Q(state=OrderPayment.PAYMENT_STATE_CREATED, info__contains='"status": "sending"')
+            # Failed without an answer from QPayPro, e.g. a read timeout,
+            # unless it was never sent at all
+            | (
+                Q(state=OrderPayment.PAYMENT_STATE_FAILED, info__contains='"error": true')
+                & ~Q(info__contains='"sent": false')
+            )
+        ).select_related('order', 'order__event', 'order__event__organizer')
+        return filter_events(qs, options['event'])
+
+    def read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return json.load(f)['last_pk']
+
+    def write_checkpoint(self, path, last_pk):
+        if not path:
+            return
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'last_pk': last_pk}, f)
+        os.replace(path + '.tmp', path)
+
+    def get_status_body(self, payment):
+        # Asked to the account the payment was sent through
+        try:
+            account = self.providers.get(payment).get_account(payment.info_data.get('x_login'))
+        except PaymentException as e:
+            logger.error('QPayPro status of %s can not be checked: %s' % (payment.full_id, e))
+            return None
+        return {
+            'x_login': account.x_login,
+            'x_private_key': account.x_private_key,
+            'x_api_secret': account.x_api_secret,
+            'x_audit_number': payment.full_id,
+            'x_invoice_num': payment.full_id,
+        }
+
+    def query_status(self, status_url, body):
+        if body is None:
+            return None
+        self.limiter.acquire()
+        try:
+            req = get_session(status_url).post(status_url, json=body, timeout=get_timeout())
+            req.raise_for_status()
+            data = req.json()
+        except (RequestException, ValueError):
+            logger.exception('QPayPro status of %s could not be checked' % body['x_audit_number'])
+            return None
+        if not isinstance(data, dict) or 'result' not in data or 'responseCode' not in data:
+            return None
+        return data
+
+    def is_same_payment(self, payment, data) -> bool:
+        # Only answers about this very attempt are applied, not about another
+        # payment of the same order
+        return data.get('x_audit_number') in (None, payment.full_id)
+
+    def is_same_amount(self, payment, data) -> bool:
+        try:
+            return Decimal(str(data.get('x_amount'))) == payment.amount
+        except InvalidOperation:
+            return False
+
+    def apply(self, batch, results, dry_run):
+        confirmed, failed = [], []
+        for payment, data in zip(batch, results):
+            if data is None:
+                continue
+            if not self.is_same_payment(payment, data):
+                logger.warning('QPayPro answered the status of %s for %s' % (data['x_audit_number'], payment.full_id))
+                continue
+
+            # The account is kept for later refunds and runs
+            x_login = payment.info_data.get('x_login')
+            if x_login:
+                data = dict(data, x_login=x_login)
+
+            if data['result'] == 1 and data['responseCode'] == 100:
+                if not self.is_same_amount(payment, data):
+                    logger.warning('QPayPro approved %s for another amount, it has to be checked by hand'
+                                   % payment.full_id)
+                    continue
+                confirmed.append(payment)
+                if not dry_run:
+                    payment.info_data = data
+                    try:
+                        payment.confirm()
+                    except Quota.QuotaExceededException:
+                        pass
+            else:
+                newly_failed = payment.state != OrderPayment.PAYMENT_STATE_FAILED
+                payment.info_data = data
+                payment.state = OrderPayment.PAYMENT_STATE_FAILED
+                failed.append((payment, newly_failed))
+
+        if failed and not dry_run:
+            OrderPayment.objects.bulk_update([payment for payment, newly_failed in failed], ['state', 'info'])
+            for payment, newly_failed in failed:
+                if not newly_failed:
+                    continue
+                payment.order.log_action('pretix.event.order.payment.failed', {
+                    'local_id': payment.local_id,
+                    'provider': payment.provider,
+                    'data': payment.info_data
+                })
+        return len(confirmed), len(failed)
+
+    def handle(self, *args, **options):
+        self.providers = ProviderCache()
+        self.limiter = RateLimiter(options['rate'])
+        last_pk = self.read_checkpoint(options['checkpoint'])
+        checked = confirmed = failed = 0
+
+        with scopes_disabled(), ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            qs = self.get_queryset(options)
+            total = qs.filter(pk__gt=last_pk).count()
+            self.stdout.write('{} payments to check.'.format(total))
+
+            while True:
+                batch = list(qs.filter(pk__gt=last_pk).order_by('pk')[:options['batch_size']])
+                if not batch:
+                    break
+
+                # The settings are read here, the threads only talk to QPayPro
+                bodies = [self.get_status_body(payment) for payment in batch]
+                results = list(executor.map(lambda body: self.query_status(options['status_url'], body), bodies))
+
+                batch_confirmed, batch_failed = self.apply(batch, results, options['dry_run'])
+                checked += len(batch)
+                confirmed += batch_confirmed
+                failed += batch_failed
+                last_pk = batch[-1].pk
+                if not options['dry_run']:
+                    self.write_checkpoint(options['checkpoint'], last_pk)
+                self.stdout.write('{}/{} checked, {} confirmed, {} failed.'.format(checked, total, confirmed, failed))
+
+        # A complete run starts over the next time
+        if options['checkpoint'] and os.path.exists(options['checkpoint']) and not options['dry_run']:
+            os.remove(options['checkpoint'])
+        self.stdout.write(self.style.SUCCESS('Done, {} confirmed and {} failed.'.format(confirmed, failed)))
@@ -0,0 +1,103 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderRefund
+from pretix.base.payment import PaymentException
+
+from ...config import PROVIDERS
+from ...throttling import RateLimiter
+from ..utils import ProviderCache, add_event_argument, filter_events
+
+
+class Command(BaseCommand):
+    help = ('Sends all the QPayPro refunds waiting to be executed, e.g. after cancelling an event, with a bounded '
+            'number of concurrent requests per QPayPro account.')
+
+    def add_arguments(self, parser):
+        add_event_argument(parser)
+        parser.add_argument('--retry-failed', action='store_true', help='Send failed refunds again as well')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent requests to QPayPro')
+        parser.add_argument('--rate', type=float, default=5,
+                            help='Maximum requests per second to each QPayPro account')
+
+    def get_queryset(self, options):
+        states = [OrderRefund.REFUND_STATE_CREATED]
+        if options['retry_failed']:
+            states.append(OrderRefund.REFUND_STATE_FAILED)
+        qs = OrderRefund.objects.filter(provider__in=PROVIDERS).select_related(
+            'order', 'order__event', 'order__event__organizer', 'payment',
+        )
+        return filter_events(qs, options['event']), states
+
+    def get_limiter(self, transport, x_login):
+        key = (transport.key, x_login)
+        if key not in self.limiters:
+            self.limiters[key] = RateLimiter(self.rate)
+        return self.limiters[key]
+
+    def send(self, provider, transport, timeout, refund_body):
+        self.get_limiter(transport, refund_body['x_login']).acquire()
+        return provider._send_refund_request(transport, timeout, refund_body)
+
+    def handle(self, *args, **options):
+        self.providers = ProviderCache()
+        self.limiters = {}
+        self.rate = options['rate']
+        done = failed = 0
+
+        with scopes_disabled(), ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            qs, states = self.get_queryset(options)
+
+            # Refunds that were being sent when an earlier run was interrupted
+            # may or may not have reached QPayPro, they're never sent again
+            # automatically
+            unknown = qs.filter(state=OrderRefund.REFUND_STATE_TRANSIT, info__contains='"status": "sending"')
+            for refund in unknown:
+                self.stdout.write(self.style.WARNING(
+                    'Refund {} was interrupted while being sent, please check it with QPayPro.'.format(refund.full_id)
+                ))
+
+            qs = qs.filter(state__in=states)
+            total = qs.count()
+            self.stdout.write('{} refunds to send.'.format(total))
+
+            last_pk = 0
+            while True:
+                batch = list(qs.filter(pk__gt=last_pk).order_by('pk')[:options['batch_size']])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+
+                # Settings and database work happen here, the threads only
+                # talk to QPayPro
+                calls, sent = [], []
+                for refund in batch:
+                    provider = self.providers.get(refund)
+                    try:
+                        transport, timeout = provider._get_transport_settings()
+                        refund_body = provider._get_refund_body(refund)
+                    except PaymentException as e:
+                        # Left as it is, e.g. the charge can't be identified
+                        self.stdout.write(self.style.WARNING('Refund {} was not sent: {}'.format(refund.full_id, e)))
+                        failed += 1
+                        continue
+                    self.get_limiter(transport, refund_body['x_login'])
+                    calls.append((provider, transport, timeout, refund_body))
+                    sent.append(refund)
+                    provider._mark_refund_sending(refund)
+
+                results = list(executor.map(lambda call: self.send(*call), calls))
+
+                for refund, (provider, transport, timeout, refund_body), (response_text, error) in zip(
+                        sent, calls, results):
+                    try:
+                        provider._process_refund_response(refund, response_text, error)
+                        done += 1
+                    except PaymentException:
+                        failed += 1
+
+                self.stdout.write('{}/{} sent, {} done, {} failed.'.format(done + failed, total, done, failed))
+
+        self.stdout.write(self.style.SUCCESS('Done, {} refunds done and {} failed.'.format(done, failed)))
@@ -0,0 +1,38 @@
+from django.core.management.base import CommandError
+from django.db.models import Q
+
+
+def add_event_argument(parser):
+    parser.add_argument('--event', nargs='*', default=[], help='Only these events, as "organizer/event"')
+
+
+def filter_events(qs, events: list, prefix: str = 'order__event__'):
+    """
+    Limits the queryset to the events given as ``organizer/event``, the
+    prefix leads from its model to the event.
+    """
+    if not events:
+        return qs
+    condition = Q()
+    for event in events:
+        try:
+            organizer, slug = event.split('/')
+        except ValueError:
+            raise CommandError('Events have to be given as "organizer/event".')
+        condition |= Q(**{prefix + 'organizer__slug': organizer, prefix + 'slug': slug})
+    return qs.filter(condition)
+
+
+class ProviderCache:
+    # Providers are cached per event, so the settings are resolved once
+    def __init__(self):
+        self.providers = {}
+
+    def get(self, obj):
+        """
+        Returns the provider of a payment or refund.
+        """
+        key = (obj.order.event_id, obj.provider)
+        if key not in self.providers:
+            self.providers[key] = obj.payment_provider
+        return self.providers[key]
@@ -0,0 +1,31 @@
+from pretix.base.metrics import Counter, Gauge, Histogram
+
+# These are collected through pretix' own metrics, they are only recorded
+# when METRICS_ENABLED is set and show up in its /metrics endpoint
+
+qpaypro_request_duration = Histogram(
+    'pretix_qpaypro_request_duration_seconds',
+    'Round-trip time of the payment requests sent to QPayPro',
+    ['endpoint', 'method'],
+    [.1, .25, .5, 1, 2, 3, 5, 10, 20, 30, 60, float('inf')],
+)
+qpaypro_responses = Counter(
+    'pretix_qpaypro_responses_total',
+    'Answers to the payment requests sent to QPayPro, by result and response code',
+    ['endpoint', 'method', 'result', 'response_code'],
+)
+qpaypro_payment_body_duration = Histogram(
+    'pretix_qpaypro_payment_body_duration_seconds',
+    'Time spent building the body of a QPayPro payment request',
+    ['method'],
+    [.005, .01, .025, .05, .1, .25, .5, 1, float('inf')],
+)
+qpaypro_fingerprint_renders = Counter(
+    'pretix_qpaypro_fingerprint_renders_total',
+    'Device fingerprint pages rendered',
+)
+qpaypro_admission_queue = Gauge(
+    'pretix_qpaypro_admission_queue',
+    'Calls waiting for their turn to be sent to QPayPro, per merchant account',
+    ['account'],
+)
@@ -1,27 +1,91 @@
+import base64
+import json
 import logging
-import urllib.parse
+import time
 from collections import OrderedDict
 from datetime import datetime
+from decimal import Decimal
 
-import requests
 from django import forms
-from django.core import signing
+from django.conf import settings as django_settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.db import transaction
 from django.http import HttpRequest
 from django.template.loader import get_template
+from django.utils import translation
 from django.utils.crypto import get_random_string
 from django.utils.translation import ugettext_lazy as _
-from pretix.base.models import Event, OrderPayment, Quota
+from pretix.base.models import Event, OrderPayment, OrderRefund, Quota
 from pretix.base.payment import BasePaymentProvider, PaymentException
 from pretix.base.settings import SettingsSandbox
 from pretix.multidomain.urlreverse import build_absolute_uri, eventreverse
-from requests import HTTPError
-
-from .formfields.custom_validators import mask_cc_number
-from .formfields.payment import get_payment_form_fields
+from requests import RequestException
+
+from . import client, tracing, vault
+from .accounts import MerchantAccount, choose_account
+from .admission import AdmissionController, AdmissionTimeout
+from .circuit import CircuitBreaker, CircuitOpenError
+from .config import (
+    SETTINGS_KEYS, ResolvedSettings, get_resolved_settings,
+    get_settings_version,
+)
+from .formfields.custom_validators import (
+    CreditCardField, mask_cc_number, normalize_card_number, validate_bins,
+    validate_installment_plans,
+)
+from .formfields.payment import (
+    get_installments_field, get_payment_form_fields,
+)
 from .formfields.settings import get_settings_form_fields
+from .idempotency import PaymentLock, get_request_fingerprint
+from .installments import get_eligible_installments, is_bin_eligible
+from .metrics import (
+    qpaypro_payment_body_duration, qpaypro_request_duration,
+    qpaypro_responses,
+)
+from .rendering import get_template_version
+
+try:
+    from asgiref.sync import async_to_sync, sync_to_async
+except ImportError:
+    async_to_sync = sync_to_async = None
 
 logger = logging.getLogger(__name__)
 
+# Fingerprint parameters of the current attempt, for browsers without
+# JavaScript
+ONLINEMETRIX_SESSION_KEY = 'pretix_qpaypro_onlinemetrix'
+
+# Seconds the rendered empty payment form is cached
+PAYMENT_FORM_CACHE_TIMEOUT = 3600
+
+# Seconds a payment body waits in the cache for a worker to pick it up
+BACKGROUND_BODY_TIMEOUT = 300
+
+
+def encode_onlinemetrix_params(params: list) -> str:
+    """
+    Token read by the fingerprint page from the URL fragment: the org id,
+    the fingerprint session id and the next URL as urlsafe base64 JSON.
+    It isn't signed as the server never reads it back, the page only
+    follows next URLs of its own origin and the payment is checked as
+    usual afterwards.
+    """
+    return base64.urlsafe_b64encode(json.dumps(params).encode()).decode().rstrip('=')
+
+
+# Payment form fields kept in the vault instead of the session
+CARD_FIELDS = (
+    'cc_type',
+    'cc_number',
+    'cc_exp_month',
+    'cc_exp_year',
+    'cc_cvv2',
+    'cc_first_name',
+    'cc_last_name',
+)
+
 
 class QPayProSettingsHolder(BasePaymentProvider):
     identifier = 'qpaypro'
@@ -33,18 +97,19 @@ class QPayProSettingsHolder(BasePaymentProvider):
     def __init__(self, event: Event):
         super().__init__(event)
         self.settings = SettingsSandbox('payment', 'qpaypro', event)
+        self._resolved_settings = None
+
+    @property
+    def resolved_settings(self) -> ResolvedSettings:
+        # Resolved once per provider instance, shared between instances
+        # through the cache until the settings are saved again
+        if self._resolved_settings is None:
+            self._resolved_settings = get_resolved_settings(self.event, self.settings)
+        return self._resolved_settings
 
     @property
     def were_general_settings_provided(self):
-        return bool(self.settings.general_x_login
-                    and self.settings.general_x_private_key
-                    and self.settings.general_x_api_secret
-                    and self.settings.general_x_endpoint
-                    and self.settings.general_x_org_id
-                    and self.settings.general_x_country
-                    and self.settings.general_x_state
-                    and self.settings.general_x_city
-                    and self.settings.general_x_address)
+        return self.resolved_settings.general
 
     @property
     def settings_form_fields(self):
@@ -64,25 +129,71 @@ class QPayProSettingsHolder(BasePaymentProvider):
                      label=_('Monthly payments'),
                      required=False,
                  )),
+                ('visaencuotas_plans',
+                 forms.CharField(
+                     label=_('Monthly payments: Plans'),
+                     required=False,
+                     help_text=_('Installment plans offered, separated by commas as "months:minimum order '
+                                 'amount", e.g. "3:500, 6:1000, 12:2000".'),
+                     validators=[validate_installment_plans],
+                 )),
+                ('visaencuotas_bins',
+                 forms.CharField(
+                     label=_('Monthly payments: Card prefixes'),
+                     required=False,
+                     help_text=_('Only cards starting with one of these numbers, separated by commas, can pay in '
+                                 'installments. Leave empty to allow any Visa card.'),
+                     validators=[validate_bins],
+                 )),
             ] + list(super().settings_form_fields.items())
         )
         d.move_to_end('_enabled', last=False)
         return d
 
-    def get_settings_key(self, key):
+    def get_account(self, x_login: str = None) -> MerchantAccount:
+        """
+        Returns the account a payment was sent through, the main one for
+        payments that don't say (sent before several accounts were
+        supported). An account that was removed since raises a
+        PaymentException, the payment can't go through another one.
+        """
+        accounts = self.resolved_settings.accounts
+        if x_login:
+            for account in accounts:
+                if account.x_login == x_login:
+                    return account
+            raise PaymentException(_('The QPayPro account {login} is not configured anymore.').format(login=x_login))
+        if accounts:
+            return accounts[0]
+        return MerchantAccount(
+            self.resolved_settings.x_login,
+            self.resolved_settings.x_private_key,
+            self.resolved_settings.x_api_secret,
+            1,
+        )
+
+    def next_account(self) -> MerchantAccount:
+        # Payments are spread over all the accounts by weighted round-robin
+        if len(self.resolved_settings.accounts) > 1:
+            return choose_account(self.resolved_settings.accounts)
+        return self.get_account()
+
+    def get_settings_key(self, key, as_type=None):
+        if key in SETTINGS_KEYS:
+            return getattr(self.resolved_settings, key)
         if (self.were_general_settings_provided):
             key = 'general_{0}'.format(key)
-        return self.settings.get(key)
+        return self.settings.get(key, as_type=as_type)
 
 
 class QPayProMethod(QPayProSettingsHolder):
     method = ''
+    card_fields = CARD_FIELDS
     abort_pending_allowed = False
     refunds_allowed = True
 
-    def __init__(self, event: Event):
-        super().__init__(event)
-        self.settings = SettingsSandbox('payment', 'qpaypro', event)
+    # Total of the form being rendered, when pretix provides it
+    payment_form_total = None
 
     @property
     def settings_form_fields(self):
@@ -94,43 +205,52 @@ class QPayProMethod(QPayProSettingsHolder):
 
     @property
     def is_enabled(self) -> bool:
-        return (
-            self.settings.get('_enabled', as_type=bool)
-            and self.settings.get('method_{}'.format(self.method), as_type=bool)
+        if not (self.resolved_settings.enabled and getattr(self.resolved_settings, 'method_{}'.format(self.method))):
+            return False
+        try:
+            transport = self._get_transport()
+        except PaymentException:
+            # Simulator outside of test mode or an incomplete custom endpoint
+            return False
+        return not (
+            self.resolved_settings.x_circuit_hide
+            and CircuitBreaker(transport.key).is_open
         )
 
     def _fingerprint_prepare(self, request, url_next):
         if not super().checkout_prepare(request, None):
             return False
+        self._store_card_data(request)
 
         # Device fingerprint session id
         session_onlinemetrix_key = self.get_payment_key_prefix() + 'session_onlinemetrix'
         if not request.session.get(session_onlinemetrix_key, False):
             request.session[session_onlinemetrix_key] = get_random_string(32)
 
-        # Device fingerprint URLs
-        params = 'org_id={x_org_id}&session_id={x_login}{session_id}'.format(
-            x_org_id=self.get_settings_key('x_org_id'),
-            x_login=self.get_settings_key('x_login'),
-            session_id=request.session.get(session_onlinemetrix_key, '')
-        )
-        url_script = '{url}/fp/tags.js?{params}'.format(
-            url=self.url_onlinemetrix,
-            params=params,
-        )
-        url_iframe = '{url}/fp/tags?{params}'.format(
-            url=self.url_onlinemetrix,
-            params=params,
-        )
-
-        # Final URL using the result of all the previous steps
-        signer = signing.Signer(salt='safe-redirect')
+        # The URL is kept in the session and only built again when
+        # the fingerprint session, the account, the org id or the next step
+        # change
+        account = self._get_session_account(request)
+        bundle = [
+            self.resolved_settings.x_org_id,
+            '{}{}'.format(account.x_login, request.session[session_onlinemetrix_key]),
+            url_next,
+        ]
+        request.session[ONLINEMETRIX_SESSION_KEY] = bundle
+        language = translation.get_language()
+        session_url_key = self.get_payment_key_prefix() + 'onlinemetrix_url'
+        cached = request.session.get(session_url_key)
+        if cached and cached[0] == bundle and cached[1] == language:
+            return cached[2]
+
+        # Final URL with a single token holding everything the fingerprint
+        # page needs. It goes in the fragment, so the page itself is the same
+        # for everyone using the same language and can be cached
         url_final = (
-            eventreverse(self.event, 'plugins:pretix_qpaypro:onlinemetrix') + '?'
-            + 'url_script=' + urllib.parse.quote(signer.sign(url_script)) + '&'
-            + 'url_iframe=' + urllib.parse.quote(signer.sign(url_iframe)) + '&'
-            + 'url_next=' + urllib.parse.quote(signer.sign(url_next))
+            eventreverse(self.event, 'plugins:pretix_qpaypro:onlinemetrix', kwargs={'lang': language}) + '#'
+            + encode_onlinemetrix_params(bundle)
         )
+        request.session[session_url_key] = [bundle, language, url_final]
         return url_final
 
     def payment_prepare(self, request, payment):
@@ -139,70 +259,160 @@ class QPayProMethod(QPayProSettingsHolder):
             'secret': payment.order.secret,
             'payment': payment.pk
         })
-        return self._fingerprint_prepare(request, url_next)
+        with tracing.span('qpaypro.fingerprint_prepare', qpaypro__method=self.method,
+                          pretix__order=payment.order.code):
+            return self._fingerprint_prepare(request, url_next)
 
     def checkout_prepare(self, request, cart):
         url_next = eventreverse(self.event, 'presale:event.checkout', kwargs={
             'step': 'confirm',
         })
-        return self._fingerprint_prepare(request, url_next)
+        with tracing.span('qpaypro.fingerprint_prepare', qpaypro__method=self.method):
+            return self._fingerprint_prepare(request, url_next)
 
     def get_payment_key_prefix(self):
         return 'payment_{0}_'.format(self.identifier)
 
-    def payment_is_valid_session(self, request: HttpRequest):
+    def _get_session_account(self, request: HttpRequest) -> MerchantAccount:
+        # The account is chosen once per attempt, the device fingerprint is
+        # tied to it
+        key = self.get_payment_key_prefix() + 'account'
+        x_login = request.session.get(key)
+        if x_login:
+            try:
+                return self.get_account(x_login)
+            except PaymentException:
+                # Removed in the meantime, the attempt gets another one
+                pass
+        account = self.next_account()
+        request.session[key] = account.x_login
+        return account
+
+    def _store_card_data(self, request: HttpRequest):
+        # The card data the form just saved in the session is moved to the
+        # vault, the session only keeps the token to find it again
         key_prefix = self.get_payment_key_prefix()
+        card_data = {
+            field: request.session.pop(key_prefix + field, '')
+            for field in self.card_fields
+        }
+        self._wipe_card_data(request)
+        token = vault.store(card_data)
+        request.session[key_prefix + 'vault'] = token
+        request._qpaypro_card_data = (token, card_data)
+
+    def _get_card_data(self, request: HttpRequest) -> dict:
+        token = request.session.get(self.get_payment_key_prefix() + 'vault')
+        if not token:
+            return {}
+
+        # Read once per request, the checkout asks for it several times
+        cached = getattr(request, '_qpaypro_card_data', None)
+        if cached and cached[0] == token:
+            return cached[1]
+        card_data = vault.load(token) or {}
+        request._qpaypro_card_data = (token, card_data)
+        return card_data
+
+    def _wipe_card_data(self, request: HttpRequest):
+        token = request.session.pop(self.get_payment_key_prefix() + 'vault', None)
+        if token:
+            vault.wipe(token)
+        request._qpaypro_card_data = None
+
+    def payment_is_valid_session(self, request: HttpRequest):
+        card_data = self._get_card_data(request)
         return (
-            request.session.get(key_prefix + 'cc_type', '') != ''
-            and request.session.get(key_prefix + 'cc_number', '') != ''
-            and request.session.get(key_prefix + 'cc_exp_month', '') != ''
-            and request.session.get(key_prefix + 'cc_exp_year', '') != ''
-            and request.session.get(key_prefix + 'cc_cvv2', '') != ''
-            and request.session.get(key_prefix + 'cc_first_name', '') != ''
-            and request.session.get(key_prefix + 'cc_last_name', '') != ''
-            and request.session.get(key_prefix + 'session_onlinemetrix', '') != ''
+            all(card_data.get(field, '') != '' for field in self.card_fields)
+            and request.session.get(self.get_payment_key_prefix() + 'session_onlinemetrix', '') != ''
         )
 
     @property
     def payment_form_fields(self):
         return OrderedDict(get_payment_form_fields())
 
-    def payment_form_render(self, request) -> str:
+    def _render_payment_form(self, form) -> str:
         template = get_template('pretix_qpaypro/checkout_payment_form.html')
         ctx = {
-            'form': self.payment_form(request),
+            'form': form,
         }
         return template.render(ctx)
 
+    def _get_payment_form_variant(self) -> str:
+        # Anything besides the settings that changes the empty form
+        return ''
+
+    def payment_form_render(self, request, total: Decimal = None) -> str:
+        self.payment_form_total = total
+        form = self.payment_form(request)
+
+        # Forms with values or errors are rendered for each customer
+        if form.is_bound or any(name in form.initial for name in form.fields):
+            return self._render_payment_form(form)
+
+        # Empty forms look the same for every customer of the event
+        key = 'pretix_qpaypro_payment_form_{}_{}_{}{}_{}_{}'.format(
+            get_template_version('pretix_qpaypro/checkout_payment_form.html'),
+            self.event.pk,
+            self.identifier,
+            self._get_payment_form_variant(),
+            translation.get_language(),
+            get_settings_version(),
+        )
+        html = cache.get(key)
+        if html is None:
+            html = self._render_payment_form(form)
+            cache.set(key, html, PAYMENT_FORM_CACHE_TIMEOUT)
+        return html
+
     def checkout_confirm_render(self, request) -> str:
         template = get_template('pretix_qpaypro/checkout_payment_confirm.html')
-        key_prefix = self.get_payment_key_prefix()
+        card_data = self._get_card_data(request)
         ctx = {
             'request': request,
             'event': self.event,
             'settings': self.settings,
             'provider': self,
-            'cc_type': request.session[key_prefix + 'cc_type'].upper(),
-            'cc_number': mask_cc_number(request.session[key_prefix + 'cc_number']),
-            'cc_exp_month': request.session[key_prefix + 'cc_exp_month'],
-            'cc_exp_year': request.session[key_prefix + 'cc_exp_year'],
-            'cc_first_name': request.session[key_prefix + 'cc_first_name'],
-            'cc_last_name': request.session[key_prefix + 'cc_last_name'],
+            'cc_type': card_data['cc_type'].upper(),
+            'cc_number': mask_cc_number(card_data['cc_number']),
+            'cc_exp_month': card_data['cc_exp_month'],
+            'cc_exp_year': card_data['cc_exp_year'],
+            'cc_first_name': card_data['cc_first_name'],
+            'cc_last_name': card_data['cc_last_name'],
+            'cc_installments': card_data.get('cc_installments'),
         }
         return template.render(ctx)
 
+    def _get_line_items(self, order):
+        # Positions of the same product, variation and price are sent as a
+        # single line, everything is loaded in one query
+        lines = OrderedDict()
+        for position in order.positions.select_related('item', 'variation'):
+            key = (position.item_id, position.variation_id, position.price)
+            if key in lines:
+                lines[key][1] += 1
+            elif position.variation:
+                lines[key] = ['{} - {}'.format(position.item.name, position.variation.value), 1, position.price]
+            else:
+                lines[key] = [str(position.item.name), 1, position.price]
+
+        return ''.join(
+            '{description}<|>{code}<|>{quantity}<|>{value}<|>'.format(
+                description=name,
+                code=name,
+                quantity=quantity,
+                value=price,
+            )
+            for name, quantity, price in lines.values()
+        )
+
     def _get_payment_body(self, request: HttpRequest, payment: OrderPayment):
         key_prefix = self.get_payment_key_prefix()
+        card_data = self._get_card_data(request)
+        account = self._get_session_account(request)
 
         # Get a complete list of the cart contents
-        x_line_item = ''
-        for line in payment.order.positions.all():
-            x_line_item += '{description}<|>{code}<|>{quantity}<|>{value}<|>'.format(
-                description=line.item.name,
-                code=line.item.name,
-                quantity='1',
-                value=line.price,
-            )
+        x_line_item = self._get_line_items(payment.order)
 
         # Get the order page for relay URL
         x_relay_url = build_absolute_uri(self.event, 'presale:event.order', kwargs={
@@ -212,93 +422,168 @@ class QPayProMethod(QPayProSettingsHolder):
 
         # Generate all the transaction body
         b = {
-            'x_login': self.get_settings_key('x_login'),
-            'x_private_key': self.get_settings_key('x_private_key'),
-            'x_api_secret': self.get_settings_key('x_api_secret'),
+            'x_login': account.x_login,
+            'x_private_key': account.x_private_key,
+            'x_api_secret': account.x_api_secret,
             'x_description': 'Order {} - {}'.format(self.event.slug.upper(), payment.full_id),
             'x_amount': str(payment.amount),
             'x_currency_code': self.event.currency,
             'x_product_id': payment.order.code,
-            'x_audit_number': payment.order.code,
+            # Every attempt has its own reference so it can be told apart
+            # from the other attempts of the order
+            'x_audit_number': payment.full_id,
             'x_line_item': x_line_item,
             'x_email': payment.order.email,
             'x_fp_sequence': payment.order.code,
             'x_fp_timestamp': str(datetime.now()),
-            'x_invoice_num': payment.order.code,
-            'x_first_name': request.session.get(key_prefix + 'cc_first_name', ''),
-            'x_last_name': request.session.get(key_prefix + 'cc_last_name', ''),
+            'x_invoice_num': payment.full_id,
+            'x_first_name': card_data.get('cc_first_name', ''),
+            'x_last_name': card_data.get('cc_last_name', ''),
             'x_company': 'C/F',
-            'x_address': self.get_settings_key('x_address'),
-            'x_city': self.get_settings_key('x_city'),
-            'x_state': self.get_settings_key('x_state'),
-            'x_zip': self.get_settings_key('x_zip'),
-            'x_country': self.get_settings_key('x_country'),
+            'x_address': self.resolved_settings.x_address,
+            'x_city': self.resolved_settings.x_city,
+            'x_state': self.resolved_settings.x_state,
+            'x_zip': self.resolved_settings.x_zip,
+            'x_country': self.resolved_settings.x_country,
             'x_relay_response': 'TRUE',
             'x_relay_url': x_relay_url,
             'x_type': 'AUTH_ONLY',
             'x_method': 'CC',
-            'visaencuotas': 0,
-            'cc_number': request.session.get(key_prefix + 'cc_number', ''),
+            'visaencuotas': int(card_data.get('cc_installments') or 0),
+            'cc_number': card_data.get('cc_number', ''),
             'cc_exp': '{}/{}'.format(
-                request.session.get(key_prefix + 'cc_exp_month', ''),
-                str(request.session.get(key_prefix + 'cc_exp_year', ''))[-2:]
+                card_data.get('cc_exp_month', ''),
+                str(card_data.get('cc_exp_year', ''))[-2:]
             ),
-            'cc_cvv2': request.session.get(key_prefix + 'cc_cvv2', ''),
+            'cc_cvv2': card_data.get('cc_cvv2', ''),
             'cc_name': '{} {}'.format(
-                request.session.get(key_prefix + 'cc_first_name', ''),
-                request.session.get(key_prefix + 'cc_last_name', ''),
+                card_data.get('cc_first_name', ''),
+                card_data.get('cc_last_name', ''),
             ),
-            'cc_type': request.session.get(key_prefix + 'cc_type', ''),
+            'cc_type': card_data.get('cc_type', ''),
             'device_fingerprint_id': request.session.get(key_prefix + 'session_onlinemetrix', ''),
         }
         return b
 
-    def execute_payment(self, request: HttpRequest, payment: OrderPayment):
+    def _simulator_allowed(self) -> bool:
+        # The simulator approves any card, it must never take real orders
+        return bool(self.event.testmode or django_settings.DEBUG)
+
+    def _get_transport(self):
+        x_endpoint = self.resolved_settings.x_endpoint
+        if x_endpoint == 'simulator':
+            if not self._simulator_allowed():
+                raise PaymentException(_('The QPayPro simulator can only be used while the shop is in test mode.'))
+            return client.get_transport(x_endpoint, simulator=client.get_simulator(
+                (self.resolved_settings.x_simulator_latency or 0) / 1000,
+                (self.resolved_settings.x_simulator_decline_ratio or 0) / 100,
+                (self.resolved_settings.x_simulator_error_ratio or 0) / 100,
+            ))
         try:
-            # Get the correct endpoint to consume
-            x_endpoint = self.get_settings_key('x_endpoint')
-            if x_endpoint == 'live':
-                url = 'https://payments.qpaypro.com/checkout/api_v1'
-            else:
-                url = 'https://sandbox.qpaypro.com/payment/api_v1'
+            return client.get_transport(x_endpoint, self.resolved_settings.x_custom_url)
+        except ValueError:
+            raise PaymentException(_('The QPayPro endpoint is not configured correctly.'))
+
+    def _get_transport_settings(self):
+        # Get the correct endpoint to consume and how long to wait for it
+        transport = self._get_transport()
+        timeout = client.get_timeout(
+            self.resolved_settings.x_timeout_connect,
+            self.resolved_settings.x_timeout_read,
+        )
+        return transport, timeout
+
+    def _get_admission_controller(self, transport, timeout: tuple, x_login: str) -> AdmissionController:
+        return AdmissionController(
+            transport.key,
+            x_login or '',
+            max_in_flight=self.resolved_settings.x_max_in_flight,
+            max_rate=self.resolved_settings.x_max_rate,
+            max_wait=self.resolved_settings.x_admission_wait,
+            call_timeout=sum(timeout),
+        )
 
-            # Get the message body
-            payment_body = self._get_payment_body(request, payment)
+    def _use_async_transport(self):
+        return bool(
+            client.async_available()
+            and async_to_sync is not None
+            and self.resolved_settings.x_async_transport
+            and client.has_long_lived_loop()
+        )
 
-            # # To save the information befor send
-            # # TO DO: to delete this action because of security issues
-            # payment.order.log_action('pretix.event.order.payment.started', {
-            #     'local_id': payment.local_id,
-            #     'provider': payment.provider,
-            #     'data': payment_body
-            # })
-
-            # Perform the call to the endpoint
-            req = requests.post(
-                url,
-                json=payment_body,
-            )
-            req.raise_for_status()
+    def _prepare_payment_call(self, request: HttpRequest, payment: OrderPayment):
+        transport, timeout = self._get_transport_settings()
+
+        # Get the message body
+        start = time.monotonic()
+        with tracing.span('qpaypro.payment_body', qpaypro__method=self.method, pretix__order=payment.order.code):
+            payment_body = self._get_payment_body(request, payment)
+        qpaypro_payment_body_duration.observe(time.monotonic() - start, method=self.method)
+
+        # # To save the information befor send
+        # # TO DO: to delete this action because of security issues
+        # payment.order.log_action('pretix.event.order.payment.started', {
+        #     'local_id': payment.local_id,
+        #     'provider': payment.provider,
+        #     'data': payment_body
+        # })
+
+        return transport, timeout, payment_body
+
+    def _process_payment_response(self, payment: OrderPayment, endpoint: str, response_text: str,
+                                  error: Exception = None, sent: bool = True):
+        # Kept with the result so refunds use the same account
+        x_login = payment.info_data.get('x_login')
+        try:
+            if error is not None:
+                qpaypro_responses.inc(
+                    1,
+                    endpoint=endpoint,
+                    method=self.method,
+                    result='error',
+                    response_code=type(error).__name__,
+                )
+                raise error
 
             # Load the response to be read
-            data = req.json()
+            data = json.loads(response_text)
+
+            qpaypro_responses.inc(
+                1,
+                endpoint=endpoint,
+                method=self.method,
+                result=str(data.get('result')),
+                response_code=str(data.get('responseCode')),
+            )
+            tracing.set_attributes(
+                qpaypro__result=str(data.get('result')),
+                qpaypro__response_code=str(data.get('responseCode')),
+            )
 
             # The result is evaluated to determine the next step
             if not (data['result'] == 1 and data['responseCode'] == 100):
                 raise PaymentException(data['responseText'])
 
             # To save the result
-            payment.info = req.json()
+            if x_login:
+                data['x_login'] = x_login
+            payment.info_data = data
             payment.confirm()
-        except (HTTPError, PaymentException, Quota.QuotaExceededException):
-            logger.exception('QPayPro error: %s' % req.text)
+        except client.TRANSPORT_ERRORS + (CircuitOpenError, AdmissionTimeout, ValueError, KeyError,
+                                          PaymentException, Quota.QuotaExceededException) as e:
+            logger.exception('QPayPro error: %s' % (response_text or e))
             try:
-                payment.info_data = req.json()
+                payment.info_data = json.loads(response_text)
             except Exception:
                 payment.info_data = {
                     'error': True,
-                    'detail': req.text
+                    'detail': response_text or str(e)
                 }
+                if not sent:
+                    # It never reached QPayPro, there is nothing to reconcile
+                    payment.info_data = dict(payment.info_data, sent=False)
+            if x_login and isinstance(payment.info_data, dict):
+                payment.info_data = dict(payment.info_data, x_login=x_login)
             payment.state = OrderPayment.PAYMENT_STATE_FAILED
             payment.save()
             payment.order.log_action('pretix.event.order.payment.failed', {
@@ -309,8 +594,309 @@ class QPayProMethod(QPayProSettingsHolder):
             raise PaymentException(_('We had trouble communicating with QPayPro. Please try again and get in touch '
                                      'with us if this problem persists.'))
 
+    def _reuse_payment_result(self, payment: OrderPayment):
+        if payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED:
+            return
+        if payment.state == OrderPayment.PAYMENT_STATE_FAILED:
+            raise PaymentException(_('We had trouble communicating with QPayPro. Please try again and get in touch '
+                                     'with us if this problem persists.'))
+        raise PaymentException(_('Your payment is still being processed. Please check the status of your order in a '
+                                 'few minutes before trying again.'))
+
+    def _claim_payment(self, payment: OrderPayment, timeout: tuple, payment_body: dict):
+        """
+        Makes sure a payment is only sent to QPayPro once, even with double
+        clicks or retries. Returns the lock to release once the payment was
+        sent, or None if it was already handled by an earlier call.
+        """
+        fingerprint = get_request_fingerprint(payment_body)
+        lock = PaymentLock(payment, sum(timeout))
+        if not lock.acquire():
+            # Someone else is sending this payment, their result is used
+            lock.wait(sum(timeout))
+            payment.refresh_from_db()
+            return self._reuse_payment_result(payment)
+
+        payment.refresh_from_db()
+        if (
+            payment.state in (OrderPayment.PAYMENT_STATE_CONFIRMED, OrderPayment.PAYMENT_STATE_FAILED)
+            or payment.info_data.get('fingerprint') == fingerprint
+        ):
+            # Either done already or an earlier call with this same request
+            # never finished, then its outcome is unknown and it is left to
+            # the reconciliation instead of charging again
+            lock.release()
+            return self._reuse_payment_result(payment)
+
+        payment.info_data = {
+            'status': 'sending',
+            'fingerprint': fingerprint,
+            'x_login': payment_body['x_login'],
+        }
+        payment.save(update_fields=['info'])
+        return lock
+
+    def _send_payment(self, payment: OrderPayment, transport, timeout: tuple, payment_body: dict):
+        lock = self._claim_payment(payment, timeout, payment_body)
+        if lock is None:
+            return
+        try:
+            with self._authorization_span(payment, transport):
+                self._send_payment_request(payment, transport, timeout, payment_body)
+        finally:
+            lock.release()
+
+    def _authorization_span(self, payment: OrderPayment, transport):
+        # Only identifiers are recorded, never anything from the card
+        return tracing.span(
+            'qpaypro.authorize',
+            client=True,
+            qpaypro__method=self.method,
+            qpaypro__endpoint=transport.name,
+            pretix__order=payment.order.code,
+            pretix__payment=payment.full_id,
+        )
+
+    def _send_payment_request(self, payment: OrderPayment, transport, timeout: tuple, payment_body: dict):
+        # Fail fast while QPayPro is known to be degraded
+        breaker = CircuitBreaker(transport.key)
+        if not breaker.allow_request():
+            self._process_payment_response(payment, transport.name, '', CircuitOpenError('QPayPro circuit is open'), sent=False)
+
+        # Wait for a turn within the limits of the merchant account
+        admission = self._get_admission_controller(transport, timeout, payment_body['x_login'])
+        try:
+            slot = admission.acquire()
+        except AdmissionTimeout as e:
+            self._process_payment_response(payment, transport.name, '', e, sent=False)
+
+        # Perform the call to the endpoint through the shared session
+        req, error = None, None
+        start = time.monotonic()
+        try:
+            req = transport.post(payment_body, timeout=timeout)
+            tracing.set_attributes(http__status_code=req.status_code)
+            req.raise_for_status()
+        except RequestException as e:
+            error = e
+        finally:
+            admission.release(slot)
+        duration = time.monotonic() - start
+        qpaypro_request_duration.observe(duration, endpoint=transport.name, method=self.method)
+
+        if error is not None:
+            breaker.record_failure()
+            self._process_payment_response(payment, transport.name, req.text if req is not None else '', error)
+        breaker.record_success(duration)
+
+        self._process_payment_response(payment, transport.name, req.text)
+
+    def _execute_payment_in_background(self, request: HttpRequest, payment: OrderPayment):
+        from .tasks import authorize_payment
+
+        transport, timeout, payment_body = self._prepare_payment_call(request, payment)
+
+        # The body (card data included) is only handed to the worker through a
+        # short-lived vault entry so it never travels through the task broker
+        body_key = vault.store(payment_body, BACKGROUND_BODY_TIMEOUT)
+
+        # Only the first of concurrent calls for a payment queues the task
+        queued = OrderPayment.objects.filter(
+            pk=payment.pk,
+            state=OrderPayment.PAYMENT_STATE_CREATED,
+        ).update(
+            state=OrderPayment.PAYMENT_STATE_PENDING,
+            info=json.dumps({'status': 'processing'}),
+        )
+        if queued:
+            # Only once the worker can see the payment as pending
+            transaction.on_commit(
+                lambda: authorize_payment.apply_async(args=(self.event.pk, payment.pk, body_key))
+            )
+        else:
+            vault.wipe(body_key)
+
+        return eventreverse(self.event, 'plugins:pretix_qpaypro:status', kwargs={
+            'order': payment.order.code,
+            'secret': payment.order.secret,
+            'payment': payment.pk,
+        })
+
+    def execute_payment(self, request: HttpRequest, payment: OrderPayment):
+        try:
+            if self.resolved_settings.x_background_authorization:
+                return self._execute_payment_in_background(request, payment)
+
+            if self._use_async_transport():
+                return async_to_sync(self.execute_payment_async)(request, payment)
+
+            transport, timeout, payment_body = self._prepare_payment_call(request, payment)
+            self._send_payment(payment, transport, timeout, payment_body)
+            return None
+        finally:
+            # Card data is only used once, a new attempt asks for it again
+            # and may go through another account
+            self._wipe_card_data(request)
+            request.session.pop(self.get_payment_key_prefix() + 'account', None)
+
+    async def execute_payment_async(self, request: HttpRequest, payment: OrderPayment):
+        """
+        Same as ``execute_payment`` but the call to QPayPro doesn't block the
+        worker, only the database and settings work runs in a thread.
+        """
+        transport, timeout, payment_body = await sync_to_async(self._prepare_payment_call)(request, payment)
+
+        lock = await sync_to_async(self._claim_payment)(payment, timeout, payment_body)
+        if lock is None:
+            return None
+        try:
+            with self._authorization_span(payment, transport):
+                await self._send_payment_request_async(payment, transport, timeout, payment_body)
+        finally:
+            await sync_to_async(lock.release, thread_sensitive=False)()
         return None
 
+    async def _send_payment_request_async(self, payment: OrderPayment, transport, timeout: tuple,
+                                          payment_body: dict):
+        # The breaker, the admission control and the lock live in the cache,
+        # which may block on the network, so they're only used from a thread
+        breaker = CircuitBreaker(transport.key)
+        if not await sync_to_async(breaker.allow_request, thread_sensitive=False)():
+            await sync_to_async(self._process_payment_response)(
+                payment, transport.name, '', CircuitOpenError('QPayPro circuit is open'), sent=False,
+            )
+
+        admission = self._get_admission_controller(transport, timeout, payment_body['x_login'])
+        try:
+            slot = await admission.acquire_async()
+        except AdmissionTimeout as e:
+            await sync_to_async(self._process_payment_response)(payment, transport.name, '', e, sent=False)
+
+        req, error = None, None
+        start = time.monotonic()
+        try:
+            req = await transport.post_async(payment_body, timeout=timeout)
+            tracing.set_attributes(http__status_code=req.status_code)
+            req.raise_for_status()
+        except client.TRANSPORT_ERRORS as e:
+            error = e
+        finally:
+            await sync_to_async(admission.release, thread_sensitive=False)(slot)
+        duration = time.monotonic() - start
+        qpaypro_request_duration.observe(duration, endpoint=transport.name, method=self.method)
+
+        if error is not None:
+            await sync_to_async(breaker.record_failure, thread_sensitive=False)()
+            await sync_to_async(self._process_payment_response)(payment, transport.name, req.text if req is not None else '', error)
+        await sync_to_async(breaker.record_success, thread_sensitive=False)(duration)
+
+        await sync_to_async(self._process_payment_response)(payment, transport.name, req.text)
+
+    def _get_charge_reference(self, payment: OrderPayment) -> str:
+        # Authorization QPayPro gave the charge, credits are sent against it
+        return payment.info_data.get('authorizationCode')
+
+    def payment_refund_supported(self, payment: OrderPayment) -> bool:
+        # Only payments QPayPro approved, and that can be told apart from the
+        # other attempts of the order, can be refunded through it
+        info = payment.info_data
+        return bool(
+            info.get('result') == 1
+            and info.get('responseCode') == 100
+            and self._get_charge_reference(payment)
+        )
+
+    def payment_partial_refund_supported(self, payment: OrderPayment) -> bool:
+        return self.payment_refund_supported(payment)
+
+    def _get_refund_body(self, refund: OrderRefund):
+        payment = refund.payment
+        auth_code = self._get_charge_reference(payment)
+        if not auth_code:
+            raise PaymentException(_('This payment can not be refunded through QPayPro.'))
+        account = self.get_account(payment.info_data.get('x_login'))
+        return {
+            'x_login': account.x_login,
+            'x_private_key': account.x_private_key,
+            'x_api_secret': account.x_api_secret,
+            'x_description': 'Refund {} - {}'.format(self.event.slug.upper(), refund.full_id),
+            'x_amount': str(refund.amount),
+            'x_currency_code': self.event.currency,
+            'x_audit_number': payment.full_id,
+            'x_invoice_num': payment.full_id,
+            'x_auth_code': auth_code,
+            'x_type': 'CREDIT',
+            'x_method': 'CC',
+        }
+
+    def _mark_refund_sending(self, refund: OrderRefund):
+        # From here on the outcome is unknown until QPayPro answers, a refund
+        # left like this after a crash has to be checked before sending again
+        refund.state = OrderRefund.REFUND_STATE_TRANSIT
+        refund.info_data = {'status': 'sending'}
+        refund.save(update_fields=['state', 'info'])
+
+    def _send_refund_request(self, transport, timeout: tuple, refund_body: dict):
+        admission = self._get_admission_controller(transport, timeout, refund_body['x_login'])
+        try:
+            slot = admission.acquire()
+        except AdmissionTimeout as e:
+            return '', e
+
+        req = None
+        with tracing.span('qpaypro.refund', client=True, qpaypro__method=self.method,
+                          qpaypro__endpoint=transport.name, pretix__payment=refund_body['x_audit_number']):
+            try:
+                req = transport.post(refund_body, timeout=timeout)
+                tracing.set_attributes(http__status_code=req.status_code)
+                req.raise_for_status()
+            except RequestException as e:
+                return req.text if req is not None else '', e
+            finally:
+                admission.release(slot)
+        return req.text, None
+
+    def _process_refund_response(self, refund: OrderRefund, response_text: str, error: Exception = None):
+        try:
+            if error is not None:
+                raise error
+            data = json.loads(response_text)
+            if not (data['result'] == 1 and data['responseCode'] == 100):
+                raise PaymentException(data['responseText'])
+            refund.info_data = data
+            refund.done()
+        except client.TRANSPORT_ERRORS + (AdmissionTimeout, ValueError, KeyError, PaymentException) as e:
+            logger.exception('QPayPro refund error: %s' % (response_text or e))
+            try:
+                refund.info_data = json.loads(response_text)
+            except Exception:
+                refund.info_data = {
+                    'error': True,
+                    'detail': response_text or str(e)
+                }
+            refund.state = OrderRefund.REFUND_STATE_FAILED
+            refund.save()
+            refund.order.log_action('pretix.event.order.refund.failed', {
+                'local_id': refund.local_id,
+                'provider': refund.provider,
+                'error': str(e),
+            })
+            raise PaymentException(_('We had trouble communicating with QPayPro. Please try again and get in touch '
+                                     'with us if this problem persists.'))
+
+    def execute_refund(self, refund: OrderRefund):
+        if self.resolved_settings.x_deferred_refunds:
+            # Left created, the qpaypro_refund command sends it
+            refund.info_data = {'status': 'deferred'}
+            refund.save(update_fields=['info'])
+            return
+
+        transport, timeout = self._get_transport_settings()
+        refund_body = self._get_refund_body(refund)
+        self._mark_refund_sending(refund)
+        response_text, error = self._send_refund_request(transport, timeout, refund_body)
+        self._process_refund_response(refund, response_text, error)
+
 
 class QPayProCC(QPayProMethod):
     method = 'creditcard'
@@ -322,3 +908,59 @@ class QPayProVisaEnCuotas(QPayProMethod):
     method = 'visaencuotas'
     verbose_name = _('Monthly payments via QPayPro')
     public_name = _('Monthly payments')
+    card_fields = CARD_FIELDS + ('cc_installments',)
+
+    def _get_eligible_installments(self, amount: Decimal) -> tuple:
+        # The plans by price band come precomputed with the resolved settings
+        return get_eligible_installments(self.resolved_settings.installment_bands, amount)
+
+    def is_allowed(self, request: HttpRequest, total: Decimal = None) -> bool:
+        return super().is_allowed(request, total) and (
+            total is None or bool(self._get_eligible_installments(total))
+        )
+
+    def order_change_allowed(self, order) -> bool:
+        return super().order_change_allowed(order) and bool(self._get_eligible_installments(order.pending_sum))
+
+    def _get_form_installment_plans(self) -> tuple:
+        # Only the plans the total reaches are offered when it is known
+        plans = self.resolved_settings.installment_plans
+        if self.payment_form_total is None:
+            return plans
+        eligible = self._get_eligible_installments(self.payment_form_total)
+        return tuple(plan for plan in plans if plan[0] in eligible)
+
+    def _get_payment_form_variant(self) -> str:
+        return '_' + '-'.join(str(months) for months, min_amount in self._get_form_installment_plans())
+
+    @property
+    def payment_form_fields(self):
+        fields = super().payment_form_fields
+        fields['cc_installments'] = get_installments_field(self._get_form_installment_plans(), self.event.currency)
+        return fields
+
+    def _validate_installments(self, request: HttpRequest, amount: Decimal) -> bool:
+        card_data = self._get_card_data(request)
+        if int(card_data.get('cc_installments') or 0) not in self._get_eligible_installments(amount):
+            messages.error(request, _('The selected number of monthly payments is not available for this amount.'))
+            return False
+        # The type is taken from the number, not from what the customer chose
+        number = normalize_card_number(str(card_data.get('cc_number', '')))
+        card = CreditCardField.card_from_number(number)
+        if not card or card['type'] != 'visa' or not is_bin_eligible(self.resolved_settings.installment_bins,
+                                                                     number):
+            messages.error(request, _('This card can not be used to pay in monthly payments.'))
+            return False
+        return True
+
+    def checkout_prepare(self, request, cart):
+        result = super().checkout_prepare(request, cart)
+        if result and not self._validate_installments(request, cart['total']):
+            return False
+        return result
+
+    def payment_prepare(self, request, payment):
+        result = super().payment_prepare(request, payment)
+        if result and not self._validate_installments(request, payment.amount):
+            return False
+        return result
@@ -0,0 +1,26 @@
+import hashlib
+from functools import lru_cache
+
+import pkg_resources
+import pretix
+from django.template.loader import get_template
+
+
+def get_release() -> str:
+    # Version of the installed package, bumped with every release
+    try:
+        return pkg_resources.get_distribution('pretix-qpaypro').version
+    except pkg_resources.DistributionNotFound:
+        return ''
+
+
+@lru_cache(maxsize=None)
+def get_template_version(template_name: str) -> str:
+    """
+    Identifies the current version of a rendered template in cache keys. It
+    changes with the template itself, with a new release of the plugin
+    (e.g. new form fields) and with pretix, whose templates and static files
+    the HTML depends on.
+    """
+    source = get_template(template_name).template.source
+    return hashlib.md5('{}\n{}\n{}'.format(get_release(), pretix.__version__, source).encode()).hexdigest()[:16]
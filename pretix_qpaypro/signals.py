@@ -1,12 +1,16 @@
 import logging
 from collections import OrderedDict
 
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from pretix.base.settings import settings_hierarkey
 from pretix.base.signals import (
-    register_global_settings, register_payment_providers,
+    register_data_exporters, register_global_settings,
+    register_payment_providers,
 )
 
+from .config import invalidate_resolved_settings
 from .formfields.settings import get_settings_form_fields
 
 logger = logging.getLogger(__name__)
@@ -25,9 +29,26 @@ def register_payment_provider(sender, **kwargs):
     ]
 
 
+@receiver(register_data_exporters, dispatch_uid="exporter_qpaypro")
+def register_data_exporter(sender, **kwargs):
+    from .exporters import QPayProTransactionsExporter
+
+    return QPayProTransactionsExporter
+
+
 settings_hierarkey.add_default('payment_qpaypro_method_creditcard', True, bool)
 
 
 @receiver(register_global_settings, dispatch_uid='qpaypro_global_settings')
 def register_global_setting(sender, **kwargs):
     return OrderedDict(get_settings_form_fields('payment_qpaypro_general_', False))
+
+
+@receiver([post_save, post_delete], dispatch_uid='qpaypro_settings_changed')
+def settings_changed(sender, instance, **kwargs):
+    # Event, organizer and global settings are all stored by hierarkey in
+    # "*_SettingsStore" models, any change to our keys drops the resolved ones
+    if not sender._meta.model_name.endswith('_settingsstore'):
+        return
+    if 'payment_qpaypro_' in getattr(instance, 'key', ''):
+        transaction.on_commit(invalidate_resolved_settings)
@@ -0,0 +1,122 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.utils.crypto import get_random_string
+
+
+class GatewaySimulator:
+    """
+    Imitates the QPayPro ``api_v1`` contract: approved payments answer with
+    ``result`` 1 and ``responseCode`` 100, declines with any other code and
+    gateway errors with an HTTP 5xx status.
+    """
+
+    RESPONSE_CODE_APPROVED = 100
+    RESPONSE_CODE_DECLINED = 300
+
+    def __init__(self, latency: float = 0.0, decline_ratio: float = 0.0, error_ratio: float = 0.0, seed=None):
+        self.latency = latency
+        self.decline_ratio = decline_ratio
+        self.error_ratio = error_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def _roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def handle(self, payload: dict) -> tuple:
+        """
+        Returns the HTTP status and the body that QPayPro would answer with,
+        after waiting for the configured latency.
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        return self.respond(payload)
+
+    def respond(self, payload: dict) -> tuple:
+        # Same as handle() without the latency, async callers wait on their own
+        roll = self._roll()
+        if roll < self.error_ratio:
+            return 500, 'Internal Server Error'
+
+        if roll < self.error_ratio + self.decline_ratio:
+            data = {
+                'result': 0,
+                'responseCode': self.RESPONSE_CODE_DECLINED,
+                'responseText': 'Declined by the QPayPro simulator',
+            }
+        else:
+            data = {
+                'result': 1,
+                'responseCode': self.RESPONSE_CODE_APPROVED,
+                'responseText': 'Approved by the QPayPro simulator',
+                'authorizationCode': get_random_string(6, '0123456789'),
+            }
+        data['x_audit_number'] = payload.get('x_audit_number')
+        data['x_amount'] = payload.get('x_amount')
+        return 200, json.dumps(data)
+
+
+class FakeGatewayServer:
+    """
+    Serves a ``GatewaySimulator`` over HTTP on localhost, for benchmarks and
+    load tests that need the whole HTTP stack.
+
+        with FakeGatewayServer(GatewaySimulator(latency=0.2)) as server:
+            requests.post(server.url, json=body)
+    """
+
+    def __init__(self, simulator: GatewaySimulator, host: str = '127.0.0.1', port: int = 0):
+        self.simulator = simulator
+        self.server = ThreadingHTTPServer((host, port), self._get_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/payment/api_v1'.format(host, port)
+
+    def _get_handler(self):
+        simulator = self.simulator
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    payload = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    payload = {}
+                status, body = simulator.handle(payload)
+                body = body.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
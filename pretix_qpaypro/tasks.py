@@ -0,0 +1,53 @@
+import logging
+
+from pretix.base.models import Event, OrderPayment
+from pretix.base.payment import PaymentException
+from pretix.base.services.tasks import EventTask
+from pretix.celery_app import app
+
+from . import vault
+from .payment import BACKGROUND_BODY_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+@app.task(base=EventTask)
+def authorize_payment(event: Event, payment: int, body_key: str):
+    payment = OrderPayment.objects.select_related('order').get(pk=payment, order__event=event)
+
+    if payment.state != OrderPayment.PAYMENT_STATE_PENDING:
+        # Handled already, the card data is of no use anymore
+        vault.wipe(body_key)
+        return
+
+    # The body is removed right away so the card data can't be sent twice
+    payment_body = vault.pop(body_key, BACKGROUND_BODY_TIMEOUT)
+
+    if payment_body is None:
+        logger.error('QPayPro payment body for %s expired before it could be sent' % payment.full_id)
+        payment.info_data = {
+            'error': True,
+            'detail': 'The payment data expired before it could be sent to QPayPro.',
+            'sent': False,
+        }
+        payment.state = OrderPayment.PAYMENT_STATE_FAILED
+        payment.save()
+        payment.order.log_action('pretix.event.order.payment.failed', {
+            'local_id': payment.local_id,
+            'provider': payment.provider,
+            'data': payment.info_data
+        })
+        return
+
+    provider = payment.payment_provider
+    try:
+        try:
+            transport, timeout = provider._get_transport_settings()
+        except PaymentException as e:
+            # The endpoint can't be used anymore, e.g. the shop left test mode
+            # while the simulator was configured
+            provider._process_payment_response(payment, 'unavailable', '', e, sent=False)
+        provider._send_payment(payment, transport, timeout, payment_body)
+    except PaymentException:
+        # The failure was already recorded on the payment
+        pass
@@ -0,0 +1,52 @@
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import propagate, trace
+except ImportError:
+    propagate = trace = None
+
+# Never recorded, even if they end up in the attributes by mistake
+SENSITIVE_ATTRIBUTES = ('cc_number', 'cc_cvv2', 'cc_exp', 'cc_exp_month', 'cc_exp_year', 'x_private_key',
+                        'x_api_secret')
+
+
+def _clean(attributes: dict) -> dict:
+    return {
+        key: value for key, value in attributes.items()
+        if value is not None and key.rsplit('.', 1)[-1] not in SENSITIVE_ATTRIBUTES
+    }
+
+
+@contextmanager
+def span(name: str, client: bool = False, **attributes):
+    """
+    Runs the block in an OpenTelemetry span. Without OpenTelemetry, or
+    without an exporter configured, nothing is recorded. Attributes are
+    given as keyword arguments with the dots replaced by double underscores,
+    e.g. ``qpaypro__method='creditcard'``.
+    """
+    if trace is None:
+        yield None
+        return
+
+    attributes = _clean({key.replace('__', '.'): value for key, value in attributes.items()})
+    kind = trace.SpanKind.CLIENT if client else trace.SpanKind.INTERNAL
+    with trace.get_tracer('pretix_qpaypro').start_as_current_span(name, kind=kind, attributes=attributes) as s:
+        yield s
+
+
+def set_attributes(**attributes):
+    # Added to the span currently running, if any
+    if trace is None:
+        return
+    current = trace.get_current_span()
+    if current.is_recording():
+        current.set_attributes(_clean({key.replace('__', '.'): value for key, value in attributes.items()}))
+
+
+def inject_headers(headers: dict = None) -> dict:
+    # Trace context for the requests sent to QPayPro
+    headers = dict(headers or {})
+    if propagate is not None:
+        propagate.inject(headers)
+    return headers
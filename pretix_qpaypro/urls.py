@@ -1,9 +1,16 @@
 from django.conf.urls import include, url
 
-from .views import onlinemetrix_view
+from .views import (
+    onlinemetrix_continue_view, onlinemetrix_legacy_view, onlinemetrix_view,
+    payment_status_view,
+)
 
 event_patterns = [
     url(r'^qpaypro/', include([
-        url(r'^onlinemetrix/$', onlinemetrix_view, name='onlinemetrix'),
+        url(r'^onlinemetrix/$', onlinemetrix_legacy_view, name='onlinemetrix.legacy'),
+        url(r'^onlinemetrix/continue/$', onlinemetrix_continue_view, name='onlinemetrix.continue'),
+        url(r'^onlinemetrix/(?P<lang>[a-zA-Z-]+)/$', onlinemetrix_view, name='onlinemetrix'),
+        url(r'^status/(?P<order>[^/]+)/(?P<secret>[A-Za-z0-9]+)/(?P<payment>[0-9]+)/$', payment_status_view,
+            name='status'),
     ])),
 ]
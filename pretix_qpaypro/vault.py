@@ -0,0 +1,56 @@
+import base64
+import hashlib
+import json
+
+from cryptography.fernet import Fernet, InvalidToken
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.crypto import get_random_string
+
+# Seconds card data is kept while the customer goes through the checkout
+VAULT_TIMEOUT = 1800
+
+
+def _get_fernet() -> Fernet:
+    # The key never reaches the cache, an entry alone can't be decrypted
+    key = hashlib.sha256('pretix_qpaypro.vault{}'.format(settings.SECRET_KEY).encode()).digest()
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def _get_cache_key(token: str) -> str:
+    return 'pretix_qpaypro_vault_{}'.format(token)
+
+
+def store(data: dict, timeout: int = VAULT_TIMEOUT) -> str:
+    """
+    Encrypts ``data`` into a single cache entry and returns the opaque token
+    to read it back.
+    """
+    token = get_random_string(32)
+    cache.set(_get_cache_key(token), _get_fernet().encrypt(json.dumps(data).encode()), timeout)
+    return token
+
+
+def load(token: str, timeout: int = VAULT_TIMEOUT):
+    """
+    Returns the data stored under ``token``, or None once it expired or was
+    wiped.
+    """
+    blob = cache.get(_get_cache_key(token))
+    if blob is None:
+        return None
+    try:
+        return json.loads(_get_fernet().decrypt(blob, ttl=timeout).decode())
+    except (InvalidToken, ValueError):
+        return None
+
+
+def wipe(token: str):
+    cache.delete(_get_cache_key(token))
+
+
+def pop(token: str, timeout: int = VAULT_TIMEOUT):
+    # Removed before it's used so the data can only be read once
+    data = load(token, timeout)
+    wipe(token)
+    return data
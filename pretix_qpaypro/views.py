@@ -1,28 +1,148 @@
+import hashlib
 import logging
+import urllib.parse
 
 from django.conf import settings
 from django.core import signing
-from django.http import HttpResponseBadRequest
-from django.shortcuts import render
+from django.core.cache import cache
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseRedirect,
+    JsonResponse,
+)
+from django.shortcuts import redirect, render
+from django.template.loader import render_to_string
+from django.utils import translation
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.crypto import constant_time_compare
 from django.utils.translation import ugettext_lazy as _
+from pretix.base.models import OrderPayment
+from pretix.multidomain.urlreverse import eventreverse
+
+from . import tracing
+from .metrics import qpaypro_fingerprint_renders
+from .payment import (
+    ONLINEMETRIX_SESSION_KEY, QPayProSettingsHolder,
+    encode_onlinemetrix_params,
+)
+from .rendering import get_template_version
 
 logger = logging.getLogger(__name__)
 
+# Seconds the rendered fingerprint page is kept in the cache
+ONLINEMETRIX_CACHE_TIMEOUT = 86400
+
+
+def _get_onlinemetrix_page(lang):
+    # The page doesn't depend on the customer, the event or the request, it
+    # is rendered once per language and deployment
+    key = 'pretix_qpaypro_onlinemetrix_{}_{}'.format(get_template_version('pretix_qpaypro/onlinemetrix.html'), lang)
+    page = cache.get(key)
+    if page is None:
+        with translation.override(lang):
+            html = render_to_string('pretix_qpaypro/onlinemetrix.html', {
+                'instance_name': settings.PRETIX_INSTANCE_NAME,
+                'url_onlinemetrix': QPayProSettingsHolder.url_onlinemetrix,
+            })
+        page = (html, '"{}"'.format(hashlib.md5(html.encode()).hexdigest()))
+        cache.set(key, page, ONLINEMETRIX_CACHE_TIMEOUT)
+    return page
+
+
+def onlinemetrix_view(request, lang, *args, **kwargs):
+    if lang not in dict(settings.LANGUAGES):
+        raise Http404()
+
+    with tracing.span('qpaypro.onlinemetrix', pretix__event=request.event.slug):
+        html, etag = _get_onlinemetrix_page(lang)
+        qpaypro_fingerprint_renders.inc(1)
+
+        # Browsers keep the page but check it on every visit, which is only
+        # answered with a 304 and keeps every attempt counted
+        r = get_conditional_response(request, etag=etag)
+        if r is None:
+            r = HttpResponse(html)
+        r['ETag'] = etag
+        patch_cache_control(r, public=True, no_cache=True)
+        r._csp_ignore = True
+        return r
+
+
+def onlinemetrix_continue_view(request, *args, **kwargs):
+    # Fingerprint page for browsers without JavaScript, which can't read the
+    # parameters from the fragment. They come from the session instead and
+    # the fingerprint is taken through the iframe variant
+    params = request.session.get(ONLINEMETRIX_SESSION_KEY)
+    if not params:
+        return HttpResponseRedirect(eventreverse(request.event, 'presale:event.index'))
+
+    org_id, session_id, url_next = params
+    r = render(request, 'pretix_qpaypro/onlinemetrix_continue.html', {
+        'instance_name': settings.PRETIX_INSTANCE_NAME,
+        'url_iframe': '{}/fp/tags?{}'.format(QPayProSettingsHolder.url_onlinemetrix, urllib.parse.urlencode({
+            'org_id': org_id,
+            'session_id': session_id,
+        })),
+        'url_next': url_next,
+    })
+    r._csp_ignore = True
+    return r
+
 
-def onlinemetrix_view(request, *args, **kwargs):
+def onlinemetrix_legacy_view(request, *args, **kwargs):
+    # Links from earlier versions, with every URL signed separately in the
+    # query string, are sent to the cacheable page
     signer = signing.Signer(salt='safe-redirect')
     try:
         url_script = signer.unsign(request.GET.get('url_script', ''))
-        url_iframe = signer.unsign(request.GET.get('url_iframe', ''))
         url_next = signer.unsign(request.GET.get('url_next', ''))
     except signing.BadSignature:
         return HttpResponseBadRequest(_('Invalid parameters'))
 
-    r = render(request, 'pretix_qpaypro/onlinemetrix.html', {
-        'url_script': url_script,
-        'url_iframe': url_iframe,
+    params = urllib.parse.parse_qs(urllib.parse.urlsplit(url_script).query)
+    bundle = [
+        params.get('org_id', [''])[0],
+        params.get('session_id', [''])[0],
+        url_next,
+    ]
+    request.session[ONLINEMETRIX_SESSION_KEY] = bundle
+    return HttpResponseRedirect(
+        eventreverse(request.event, 'plugins:pretix_qpaypro:onlinemetrix', kwargs={
+            'lang': translation.get_language(),
+        }) + '#' + encode_onlinemetrix_params(bundle)
+    )
+
+
+def payment_status_view(request, *args, **kwargs):
+    payment = OrderPayment.objects.select_related('order').filter(
+        order__event=request.event,
+        order__code=kwargs['order'],
+        pk=kwargs['payment'],
+    ).first()
+    if not payment or not constant_time_compare(payment.order.secret.lower(), kwargs['secret'].lower()):
+        raise Http404(_('Unknown payment.'))
+
+    done = payment.state != OrderPayment.PAYMENT_STATE_PENDING
+    url_next = eventreverse(request.event, 'presale:event.order', kwargs={
+        'order': payment.order.code,
+        'secret': payment.order.secret,
+    })
+    if payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED:
+        url_next += '?paid=yes'
+
+    # The status page polls this same URL until the worker is done
+    if request.GET.get('ajax'):
+        return JsonResponse({
+            'state': payment.state,
+            'done': done,
+            'url_next': url_next,
+        })
+
+    if done:
+        return redirect(url_next)
+
+    r = render(request, 'pretix_qpaypro/payment_status.html', {
+        'url_status': request.path + '?ajax=1',
         'url_next': url_next,
-        'settings': settings,
     })
     r._csp_ignore = True
     return r
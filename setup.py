@@ -34,7 +34,12 @@ setup(
     author_email='alvaro.ruano90@outlook.com',
     license='Apache Software License',
 
-    install_requires=[],
+    install_requires=['cryptography'],
+    extras_require={
+        'async': ['httpx'],
+        'batch': ['numpy'],
+        'tracing': ['opentelemetry-api'],
+    },
     packages=find_packages(exclude=['tests', 'tests.*']),
     include_package_data=True,
     cmdclass=cmdclass,
@@ -0,0 +1,127 @@
+import datetime
+from decimal import Decimal
+from importlib import import_module
+
+import pytest
+from django.conf import settings
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import cache
+from django.test import RequestFactory
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Order, OrderPayment, Organizer
+
+from pretix_qpaypro.simulator import FakeGatewayServer, GatewaySimulator
+
+CARD_DATA = {
+    'cc_type': 'visa',
+    'cc_number': '4111111111111111',
+    'cc_exp_month': 12,
+    'cc_exp_year': datetime.date.today().year + 2,
+    'cc_cvv2': 123,
+    'cc_first_name': 'John',
+    'cc_last_name': 'Doe',
+}
+
+
+@pytest.fixture(autouse=True)
+def locmem_cache(settings):
+    # Locks, circuit and vault live in the cache, the dummy one forgets them
+    settings.CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'pretix_qpaypro_tests',
+        },
+    }
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def no_scopes():
+    with scopes_disabled():
+        yield
+
+
+@pytest.fixture
+def event(db):
+    organizer = Organizer.objects.create(name='Dummy', slug='dummy')
+    event = Event.objects.create(
+        organizer=organizer, name='Dummy', slug='dummy', currency='GTQ',
+        date_from=now() + datetime.timedelta(days=30), plugins='pretix_qpaypro', live=True,
+    )
+    event.settings.set('payment_qpaypro__enabled', True)
+    event.settings.set('payment_qpaypro_method_creditcard', True)
+    event.settings.set('payment_qpaypro_method_visaencuotas', True)
+    event.settings.set('payment_qpaypro_visaencuotas_plans', '3:500, 6:1000, 12:2000')
+    event.settings.set('payment_qpaypro_x_login', 'login')
+    event.settings.set('payment_qpaypro_x_private_key', 'private')
+    event.settings.set('payment_qpaypro_x_api_secret', 'secret')
+    event.settings.set('payment_qpaypro_x_org_id', 'org')
+    event.settings.set('payment_qpaypro_x_endpoint', 'sandbox')
+    return event
+
+
+@pytest.fixture
+def gateway(event):
+    """
+    Points the event to a fake QPayPro on localhost, the simulator can be
+    changed by the test to decline payments or fail.
+    """
+    simulator = GatewaySimulator()
+    with FakeGatewayServer(simulator) as server:
+        event.settings.set('payment_qpaypro_x_endpoint', 'custom')
+        event.settings.set('payment_qpaypro_x_custom_url', server.url)
+        yield simulator
+
+
+@pytest.fixture
+def make_order(event):
+    def make_order(positions=1, price=Decimal('100.00'), provider='qpaypro_creditcard'):
+        item = event.items.create(name='Ticket', default_price=price)
+        order = Order.objects.create(
+            event=event, code='FOO{}'.format(Order.objects.count()), email='dummy@dummy.dummy',
+            status=Order.STATUS_PENDING, datetime=now(), expires=now() + datetime.timedelta(days=10),
+            total=price * positions, locale='en',
+        )
+        for positionid in range(1, positions + 1):
+            order.positions.create(item=item, price=price, positionid=positionid)
+        payment = order.payments.create(provider=provider, amount=order.total, state=OrderPayment.PAYMENT_STATE_CREATED)
+        return order, payment
+    return make_order
+
+
+@pytest.fixture
+def make_request():
+    def make_request(data=None):
+        request = RequestFactory().post('/', data or {}) if data is not None else RequestFactory().get('/')
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        request._messages = FallbackStorage(request)
+        return request
+    return make_request
+
+
+@pytest.fixture
+def card_request(make_request):
+    """
+    Returns a request that went through the payment step of a provider, with
+    the card data in the vault.
+    """
+    def card_request(provider, **card_data):
+        request = make_request()
+        prefix = provider.get_payment_key_prefix()
+        for key, value in dict(CARD_DATA, **card_data).items():
+            request.session[prefix + key] = value
+        request.session[prefix + 'session_onlinemetrix'] = 'fingerprint'
+        provider._store_card_data(request)
+        return request
+    return card_request
+
+
+def card_post_data(provider, **card_data):
+    # What the payment step form posts
+    prefix = 'payment_{}-'.format(provider.identifier)
+    data = {prefix + key: value for key, value in dict(CARD_DATA, **card_data).items()}
+    data['payment'] = provider.identifier
+    return data
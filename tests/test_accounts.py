@@ -0,0 +1,29 @@
+import pytest
+from pretix.base.payment import PaymentException
+
+from pretix_qpaypro.accounts import get_schedule, parse_accounts
+
+
+def test_parse_accounts():
+    accounts = parse_accounts('second,key,secret,3\n\nthird,key,secret')
+    assert [(account.x_login, account.weight) for account in accounts] == [('second', 3), ('third', 1)]
+    with pytest.raises(ValueError):
+        parse_accounts('second,key', strict=True)
+
+
+def test_schedule_follows_the_weights():
+    schedule = get_schedule((1, 3))
+    assert len(schedule) == 4
+    assert schedule.count(1) == 3
+
+
+def test_get_account(event, make_order):
+    event.settings.set('payment_qpaypro_x_accounts', 'second,key,secret')
+    order, payment = make_order()
+    provider = payment.payment_provider
+    assert provider.get_account('second').x_login == 'second'
+    # Payments from before the pool was added went through the main account
+    assert provider.get_account(None).x_login == 'login'
+    # Never another account than the one that was charged
+    with pytest.raises(PaymentException):
+        provider.get_account('removed')
@@ -0,0 +1,39 @@
+import time
+
+import pytest
+
+from pretix_qpaypro.admission import AdmissionController, AdmissionTimeout
+
+
+def test_disabled_without_limits():
+    controller = AdmissionController('sandbox', 'login')
+    assert not controller.enabled
+    assert controller.acquire() is True
+
+
+def test_in_flight_limit():
+    controller = AdmissionController('sandbox', 'login', max_in_flight=2, max_wait=0.1)
+    first, second = controller.acquire(), controller.acquire()
+    assert first and second and first != second
+    with pytest.raises(AdmissionTimeout):
+        controller.acquire()
+
+    controller.release(first)
+    assert controller.acquire()
+
+
+def test_limits_are_per_account():
+    AdmissionController('sandbox', 'login', max_in_flight=1).acquire()
+    assert AdmissionController('sandbox', 'other', max_in_flight=1).try_acquire()
+    assert not AdmissionController('sandbox', 'login', max_in_flight=1).try_acquire()
+
+
+def test_rate_limit(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    controller = AdmissionController('sandbox', 'login', max_rate=3)
+    assert [bool(controller.try_acquire()) for i in range(5)] == [True, True, True, False, False]
+
+    # The next second starts over
+    now[0] += 1
+    assert controller.try_acquire()
@@ -0,0 +1,115 @@
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+from pretix.base.payment import PaymentException
+
+from pretix_qpaypro import circuit
+
+from .conftest import card_post_data
+
+pytest.importorskip('pytest_benchmark')
+
+POSITIONS = [1, 10, 500]
+
+SCENARIOS = {
+    'success': {},
+    'decline': {'decline_ratio': 1},
+    '5xx': {'error_ratio': 1},
+}
+
+
+@pytest.fixture
+def scenario(request, gateway, monkeypatch):
+    for attribute, value in SCENARIOS[request.param].items():
+        setattr(gateway, attribute, value)
+    # Every round has to reach the gateway, also when all of them fail
+    monkeypatch.setattr(circuit, 'MIN_CALLS', 10 ** 6)
+    return request.param
+
+
+def execute_payment(provider, request, payment):
+    try:
+        provider.execute_payment(request, payment)
+    except PaymentException:
+        pass
+
+
+def record_costs(benchmark, func, *args):
+    # Queries and allocations of a single call, besides the timings
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            func(*args)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info['queries'] = len(queries.captured_queries)
+    benchmark.extra_info['peak_kib'] = round(peak / 1024, 1)
+
+
+def new_payment(payment):
+    # A payment is only sent once, every call needs a new one
+    return payment.order.payments.create(provider=payment.provider, amount=payment.amount,
+                                         state=OrderPayment.PAYMENT_STATE_CREATED)
+
+
+@pytest.mark.parametrize('scenario', list(SCENARIOS), indirect=True)
+@pytest.mark.parametrize('positions', POSITIONS)
+def test_execute_payment(benchmark, event, scenario, make_order, card_request, positions):
+    order, payment = make_order(positions=positions)
+    provider = payment.payment_provider
+    record_costs(benchmark, execute_payment, provider, card_request(provider), new_payment(payment))
+
+    def setup():
+        return (provider, card_request(provider), new_payment(payment)), {}
+
+    benchmark.pedantic(execute_payment, setup=setup, rounds=20)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('scenario', list(SCENARIOS), indirect=True)
+@pytest.mark.parametrize('concurrency', [10, 50])
+def test_execute_payment_concurrent(benchmark, event, scenario, make_order, card_request, concurrency):
+    order, payment = make_order(positions=10)
+    provider = payment.payment_provider
+
+    def send(call):
+        with scopes_disabled():
+            execute_payment(provider, *call)
+
+    def run(calls):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(send, calls))
+
+    def setup():
+        return ([(card_request(provider), new_payment(payment)) for i in range(concurrency)],), {}
+
+    benchmark.pedantic(run, setup=setup, rounds=5)
+    benchmark.extra_info['payments_per_second'] = round(concurrency / benchmark.stats.stats.mean, 1)
+
+
+@pytest.mark.parametrize('positions', POSITIONS)
+def test_payment_body(benchmark, event, make_order, card_request, positions):
+    order, payment = make_order(positions=positions)
+    provider = payment.payment_provider
+    request = card_request(provider)
+    record_costs(benchmark, provider._get_payment_body, request, payment)
+
+    body = benchmark(provider._get_payment_body, request, payment)
+    assert body['x_amount'] == str(payment.amount)
+
+
+def test_payment_prepare(benchmark, event, make_order, make_request):
+    order, payment = make_order()
+    provider = payment.payment_provider
+    record_costs(benchmark, provider.payment_prepare, make_request(card_post_data(provider)), payment)
+
+    def setup():
+        return (make_request(card_post_data(provider)), payment), {}
+
+    benchmark.pedantic(provider.payment_prepare, setup=setup, rounds=50)
@@ -0,0 +1,89 @@
+import time
+
+from pretix_qpaypro import circuit
+from pretix_qpaypro.circuit import CircuitBreaker
+
+
+def open_circuit(breaker):
+    for i in range(circuit.MIN_CALLS):
+        breaker.record_failure()
+
+
+def test_closed_by_default():
+    breaker = CircuitBreaker('sandbox')
+    assert breaker.allow_request()
+    assert not breaker.is_open
+
+
+def test_opens_after_failures():
+    breaker = CircuitBreaker('sandbox')
+    open_circuit(breaker)
+    assert breaker.is_open
+    assert not CircuitBreaker('sandbox').allow_request()
+    assert CircuitBreaker('live').allow_request()
+
+
+def test_few_failures_keep_it_closed():
+    breaker = CircuitBreaker('sandbox')
+    for i in range(circuit.MIN_CALLS):
+        breaker.record_success(0.1)
+    for i in range(circuit.MIN_CALLS // 2 - 1):
+        breaker.record_failure()
+    assert not breaker.is_open
+
+
+def test_slow_calls_count_as_failures():
+    breaker = CircuitBreaker('sandbox')
+    for i in range(circuit.MIN_CALLS):
+        breaker.record_success(circuit.SLOW_CALL)
+    assert breaker.is_open
+
+
+def test_single_probe_when_half_open(monkeypatch):
+    open_circuit(CircuitBreaker('sandbox'))
+    monkeypatch.setattr(time, 'time', lambda now=time.time(): now + circuit.OPEN_TIME + 1)
+
+    probe, other = CircuitBreaker('sandbox'), CircuitBreaker('sandbox')
+    assert probe.allow_request()
+    assert not other.allow_request()
+
+
+def test_only_the_probe_closes_it(monkeypatch):
+    started_before = CircuitBreaker('sandbox')
+    assert started_before.allow_request()
+    open_circuit(CircuitBreaker('sandbox'))
+    monkeypatch.setattr(time, 'time', lambda now=time.time(): now + circuit.OPEN_TIME + 1)
+
+    probe = CircuitBreaker('sandbox')
+    assert probe.allow_request()
+    started_before.record_success(0.1)
+    assert not CircuitBreaker('sandbox').allow_request()
+
+    probe.record_success(0.1)
+    assert CircuitBreaker('sandbox').allow_request()
+
+
+def test_failed_probe_opens_it_again(monkeypatch):
+    open_circuit(CircuitBreaker('sandbox'))
+    monkeypatch.setattr(time, 'time', lambda now=time.time(): now + circuit.OPEN_TIME + 1)
+
+    probe = CircuitBreaker('sandbox')
+    assert probe.allow_request()
+    probe.record_failure()
+    assert probe.is_open
+
+
+def test_late_failures_dont_reopen_it(monkeypatch):
+    started_before = CircuitBreaker('sandbox')
+    assert started_before.allow_request()
+    open_circuit(CircuitBreaker('sandbox'))
+    monkeypatch.setattr(time, 'time', lambda now=time.time(): now + circuit.OPEN_TIME + 1)
+
+    probe = CircuitBreaker('sandbox')
+    assert probe.allow_request()
+    started_before.record_failure()
+    started_before.record_success(circuit.SLOW_CALL)
+    assert not probe.is_open
+
+    probe.record_success(0.1)
+    assert CircuitBreaker('sandbox').allow_request()
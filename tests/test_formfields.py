@@ -0,0 +1,11 @@
+from django.utils.functional import Promise
+
+from pretix_qpaypro.formfields.settings import get_settings_form_fields
+
+
+def test_settings_help_texts_stay_lazy():
+    # The prototypes are cached, a plain str would keep the first language
+    fields = dict(get_settings_form_fields('', True))
+    assert isinstance(fields['x_login'].help_text, Promise)
+    assert isinstance(fields['x_org_id'].help_text, Promise)
+    assert 'Public Key' in str(fields['x_login'].help_text)
@@ -0,0 +1,55 @@
+import pytest
+from pretix.base.models import OrderPayment
+from pretix.base.payment import PaymentException
+
+from pretix_qpaypro.idempotency import PaymentLock, get_request_fingerprint
+
+
+def test_fingerprint_ignores_volatile_fields():
+    body = {'x_amount': '10.00', 'cc_number': '4111111111111111', 'x_fp_timestamp': '1'}
+    assert get_request_fingerprint(body) == get_request_fingerprint(dict(body, x_fp_timestamp='2'))
+    assert get_request_fingerprint(body) != get_request_fingerprint(dict(body, x_amount='11.00'))
+    assert '4111111111111111' not in get_request_fingerprint(body)
+
+
+def test_lock(make_order):
+    order, payment = make_order()
+    first, second = PaymentLock(payment, 1), PaymentLock(payment, 1)
+    assert first.acquire()
+    assert not second.acquire()
+    assert not second.wait(0)
+
+    # Only the holder releases it
+    second.release()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+
+
+def test_payment_is_sent_once(event, gateway, make_order, card_request):
+    calls = []
+    handle = gateway.handle
+    gateway.handle = lambda payload: calls.append(payload) or handle(payload)
+
+    order, payment = make_order()
+    provider = payment.payment_provider
+    provider.execute_payment(card_request(provider), payment)
+    provider.execute_payment(card_request(provider), payment)
+    assert len(calls) == 1
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+def test_unfinished_call_is_not_repeated(event, gateway, make_order, card_request):
+    order, payment = make_order()
+    provider = payment.payment_provider
+    request = card_request(provider)
+    transport, timeout, payment_body = provider._prepare_payment_call(request, payment)
+
+    # An earlier call with the same request never got an answer
+    payment.info_data = {'status': 'sending', 'fingerprint': get_request_fingerprint(payment_body)}
+    payment.save()
+    with pytest.raises(PaymentException):
+        provider._send_payment(payment, transport, timeout, payment_body)
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CREATED
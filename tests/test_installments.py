@@ -0,0 +1,40 @@
+from decimal import Decimal
+
+import pytest
+
+from pretix_qpaypro.installments import (
+    build_installment_bands, get_eligible_installments, is_bin_eligible,
+    parse_bins, parse_installment_plans,
+)
+
+
+def test_parse_installment_plans():
+    assert parse_installment_plans('6:1000, 3:500\n12:2000') == (
+        (3, Decimal('500')), (6, Decimal('1000')), (12, Decimal('2000')),
+    )
+    assert parse_installment_plans('3:500, foo, 1:10') == ((3, Decimal('500')),)
+    with pytest.raises(ValueError):
+        parse_installment_plans('3:500, foo', strict=True)
+
+
+def test_parse_bins():
+    assert parse_bins('411111, 4012') == ('411111', '4012')
+    with pytest.raises(ValueError):
+        parse_bins('41x', strict=True)
+
+
+@pytest.mark.parametrize('amount,expected', [
+    (Decimal('100'), ()),
+    (Decimal('500'), (3,)),
+    (Decimal('1500'), (3, 6)),
+    (Decimal('5000'), (3, 6, 12)),
+])
+def test_eligible_installments(amount, expected):
+    bands = build_installment_bands(parse_installment_plans('3:500, 6:1000, 12:2000'))
+    assert get_eligible_installments(bands, amount) == expected
+
+
+def test_bin_eligible():
+    assert is_bin_eligible((), '4111111111111111')
+    assert is_bin_eligible(('4111',), '4111111111111111')
+    assert not is_bin_eligible(('4012',), '4111111111111111')
@@ -0,0 +1,177 @@
+import base64
+import json
+from decimal import Decimal
+
+import pytest
+from pretix.base.models import OrderPayment, OrderRefund
+from pretix.base.payment import PaymentException
+
+from pretix_qpaypro import payment as payment_module, vault
+from pretix_qpaypro.payment import ONLINEMETRIX_SESSION_KEY
+from pretix_qpaypro.views import onlinemetrix_continue_view
+
+from .conftest import CARD_DATA, card_post_data
+
+
+def test_payment_body_line_items(event, make_order, card_request):
+    order, payment = make_order(positions=10)
+    provider = payment.payment_provider
+    body = provider._get_payment_body(card_request(provider), payment)
+    assert body['x_line_item'] == 'Ticket<|>Ticket<|>10<|>100.00<|>'
+    assert body['cc_number'] == CARD_DATA['cc_number']
+    assert body['x_amount'] == '1000.00'
+
+def test_deferred_refund(event, make_order):
+    event.settings.set('payment_qpaypro_x_deferred_refunds', True)
+    order, payment = make_order()
+    payment.state = OrderPayment.PAYMENT_STATE_CONFIRMED
+    payment.info_data = {'result': 1, 'responseCode': 100}
+    payment.save()
+    refund = order.refunds.create(provider=payment.provider, payment=payment, amount=payment.amount,
+                                  source=OrderRefund.REFUND_SOURCE_ADMIN, state=OrderRefund.REFUND_STATE_CREATED)
+
+    refund.payment_provider.execute_refund(refund)
+    refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_CREATED
+    assert refund.info_data == {'status': 'deferred'}
+
+def test_execute_payment_approved(event, gateway, make_order, card_request):
+    order, payment = make_order()
+    provider = payment.payment_provider
+
+    provider.execute_payment(card_request(provider), payment)
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert payment.info_data['x_login'] == 'login'
+
+
+def test_execute_payment_declined(event, gateway, make_order, card_request):
+    gateway.decline_ratio = 1
+    order, payment = make_order()
+    provider = payment.payment_provider
+
+    with pytest.raises(PaymentException):
+        provider.execute_payment(card_request(provider), payment)
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+    assert payment.info_data['result'] == 0
+
+
+def test_execute_payment_gateway_error(event, gateway, make_order, card_request):
+    gateway.error_ratio = 1
+    order, payment = make_order()
+    provider = payment.payment_provider
+
+    with pytest.raises(PaymentException):
+        provider.execute_payment(card_request(provider), payment)
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+    assert payment.info_data['error']
+
+
+def test_responses_are_counted_by_transport(event, gateway, make_order, card_request, monkeypatch):
+    labels = []
+    monkeypatch.setattr(payment_module.qpaypro_responses, 'inc', lambda amount, **kwargs: labels.append(kwargs))
+    order, payment = make_order()
+    provider = payment.payment_provider
+
+    provider.execute_payment(card_request(provider), payment)
+    assert [label['endpoint'] for label in labels] == ['custom']
+
+
+def test_simulator_only_in_test_mode(event, make_order):
+    event.settings.set('payment_qpaypro_x_endpoint', 'simulator')
+    order, payment = make_order()
+    assert not payment.payment_provider.is_enabled
+
+    event.testmode = True
+    event.save()
+    assert event.get_payment_providers()['qpaypro_creditcard'].is_enabled
+
+
+def test_fingerprint_prepare_moves_card_data_to_vault(event, make_order, make_request):
+    order, payment = make_order()
+    provider = payment.payment_provider
+    request = make_request(card_post_data(provider))
+
+    url = provider._fingerprint_prepare(request, '/next/')
+    token = url.split('#')[1]
+    params = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    assert params == request.session[ONLINEMETRIX_SESSION_KEY]
+    assert params[2] == '/next/'
+    assert all(CARD_DATA['cc_number'] not in str(value) for value in request.session.values())
+    assert provider._get_card_data(request)['cc_number'] == CARD_DATA['cc_number']
+    assert provider.payment_is_valid_session(request)
+
+    # The same attempt gets the same URL
+    again = make_request(card_post_data(provider))
+    again.session = request.session
+    assert provider._fingerprint_prepare(again, '/next/') == url
+
+
+def test_fingerprint_prepare_invalid_card(event, make_order, make_request):
+    order, payment = make_order()
+    provider = payment.payment_provider
+    assert not provider._fingerprint_prepare(make_request(card_post_data(provider, cc_number='1234')), '/next/')
+
+
+def test_fingerprint_continue_without_javascript(event, make_request):
+    request = make_request()
+    request.event = event
+    assert onlinemetrix_continue_view(request).status_code == 302
+
+    request.session[ONLINEMETRIX_SESSION_KEY] = ['org', 'loginfingerprint', '/next/']
+    response = onlinemetrix_continue_view(request)
+    assert response.status_code == 200
+    assert b'session_id=loginfingerprint' in response.content
+    assert b'url=/next/' in response.content
+
+
+def test_card_data_is_used_once(event, gateway, make_order, card_request):
+    order, payment = make_order()
+    provider = payment.payment_provider
+    request = card_request(provider)
+    token = request.session[provider.get_payment_key_prefix() + 'vault']
+
+    provider.execute_payment(request, payment)
+    assert vault.load(token) is None
+    assert provider._get_card_data(request) == {}
+
+@pytest.mark.parametrize('number,valid', [
+    ('4111111111111111', True),
+    # Chosen as Visa in the form but not a Visa card
+    ('5555555555554444', False),
+])
+def test_installments_use_the_detected_card_type(event, make_order, card_request, number, valid):
+    order, payment = make_order(price=Decimal('600.00'), provider='qpaypro_visaencuotas')
+    provider = payment.payment_provider
+    request = card_request(provider, cc_type='visa', cc_number=number, cc_installments='3')
+    assert provider._validate_installments(request, payment.amount) is valid
+
+
+def test_installment_choices_follow_the_total(event, make_order):
+    order, payment = make_order(provider='qpaypro_visaencuotas')
+    provider = payment.payment_provider
+    assert [c for c, label in provider.payment_form_fields['cc_installments'].choices] == ['3', '6', '12']
+
+    provider.payment_form_total = Decimal('1500.00')
+    assert [c for c, label in provider.payment_form_fields['cc_installments'].choices] == ['3', '6']
+
+
+def test_refund_credits_the_charge(event, make_order):
+    order, payment = make_order()
+    payment.state = OrderPayment.PAYMENT_STATE_CONFIRMED
+    payment.info_data = {'result': 1, 'responseCode': 100}
+    payment.save()
+    provider = payment.payment_provider
+    # Without the authorization the charge can't be told apart
+    assert not provider.payment_refund_supported(payment)
+
+    payment.info_data = {'result': 1, 'responseCode': 100, 'authorizationCode': '123456'}
+    payment.save()
+    assert provider.payment_refund_supported(payment)
+    refund = order.refunds.create(provider=payment.provider, payment=payment, amount=payment.amount,
+                                  source=OrderRefund.REFUND_SOURCE_ADMIN, state=OrderRefund.REFUND_STATE_CREATED)
+    body = provider._get_refund_body(refund)
+    assert body['x_auth_code'] == '123456'
+    assert body['x_audit_number'] == payment.full_id
@@ -0,0 +1,47 @@
+from pretix.base.models import OrderPayment
+
+from pretix_qpaypro.management.commands.qpaypro_reconcile import Command
+
+
+def answer(payment, **data):
+    return dict({
+        'result': 1,
+        'responseCode': 100,
+        'responseText': 'Approved',
+        'x_audit_number': payment.full_id,
+        'x_amount': str(payment.amount),
+    }, **data)
+
+
+def failed_payment(make_order, **info):
+    order, payment = make_order()
+    payment.state = OrderPayment.PAYMENT_STATE_FAILED
+    payment.info_data = dict({'error': True, 'detail': 'Read timed out'}, **info)
+    payment.save()
+    return payment
+
+
+def test_confirms_the_same_payment(event, make_order):
+    payment = failed_payment(make_order)
+    assert Command().apply([payment], [answer(payment)], False) == (1, 0)
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+def test_ignores_another_attempt(event, make_order):
+    payment = failed_payment(make_order)
+    assert Command().apply([payment], [answer(payment, x_audit_number=payment.order.code + '-P-9')], False) == (0, 0)
+    payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_FAILED
+
+
+def test_ignores_another_amount(event, make_order):
+    payment = failed_payment(make_order)
+    assert Command().apply([payment], [answer(payment, x_amount='1.00')], False) == (0, 0)
+
+
+def test_skips_payments_never_sent(event, make_order):
+    sent, never_sent = failed_payment(make_order), failed_payment(make_order, sent=False)
+    qs = Command().get_queryset({'days': 7, 'min_age': -10, 'event': []})
+    assert list(qs) == [sent]
+    assert never_sent not in qs
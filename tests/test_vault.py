@@ -0,0 +1,32 @@
+from django.core.cache import cache
+
+from pretix_qpaypro import vault
+
+
+def test_store_and_load():
+    token = vault.store({'cc_number': '4111111111111111'})
+    assert vault.load(token) == {'cc_number': '4111111111111111'}
+
+
+def test_cache_never_holds_plain_data():
+    token = vault.store({'cc_number': '4111111111111111'})
+    assert b'4111111111111111' not in cache.get('pretix_qpaypro_vault_{}'.format(token))
+
+
+def test_pop_reads_once():
+    token = vault.store({'cc_cvv2': 123})
+    assert vault.pop(token) == {'cc_cvv2': 123}
+    assert vault.pop(token) is None
+
+
+def test_wipe():
+    token = vault.store({'cc_cvv2': 123})
+    vault.wipe(token)
+    assert vault.load(token) is None
+
+
+def test_unknown_or_tampered_token():
+    assert vault.load('unknown') is None
+    token = vault.store({'cc_cvv2': 123})
+    cache.set('pretix_qpaypro_vault_{}'.format(token), b'garbage')
+    assert vault.load(token) is None